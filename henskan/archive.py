@@ -31,6 +31,22 @@ class Archive(ABC):
         pass
     
     
+    # Add an already encoded image, without going through the disk
+    @abstractmethod
+    def add_bytes(self, arcname, data):
+        pass
+    
+    
+    @abstractmethod
+    def add_image(self, arcname, image):
+        pass
+    
+    
+    @abstractmethod
+    def get_output_path(self):
+        pass
+    
+    
     @abstractmethod
     def close(self):
         pass
@@ -18,7 +18,9 @@
 
 import os.path
 import time
-from zipfile import ZipFile, ZIP_STORED
+from zipfile import ZipFile, ZipInfo, ZIP_STORED
+
+from .image import save_png
 
 
 class ArchiveCBZ(object):
@@ -37,6 +39,31 @@ class ArchiveCBZ(object):
         self._zipfile.write(filename, arcname)
     
     
+    def _new_zip_info(self, arcname):
+        # type: (str) -> ZipInfo
+        zip_info = ZipInfo(arcname, date_time=time.localtime(time.time())[:6])
+        zip_info.compress_type = ZIP_STORED
+        zip_info.external_attr = 0o644 << 16  # like a classic file, writestr() default is 0o600
+        return zip_info
+    
+    
+    def add_bytes(self, arcname, data):
+        # type: (str, bytes) -> None
+        self._zipfile.writestr(self._new_zip_info(arcname), data)
+    
+    
+    # The image is encoded directly in the zip, no intermediate buffer
+    def add_image(self, arcname, image):
+        # type: (str, Image) -> None
+        with self._zipfile.open(self._new_zip_info(arcname), 'w') as f:
+            save_png(image, f)
+    
+    
+    def get_output_path(self):
+        # type: () -> str
+        return self._output_path
+    
+    
     def close(self):
         t0 = time.time()
         self._zipfile.close()
@@ -16,12 +16,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import io
 import os.path
 import time
 
+from PIL import Image
+from reportlab.lib.utils import ImageReader
 from reportlab.pdfgen import canvas
 
-from .image import EReaderData
+from .image import EReaderData, get_pdf_page_image
 
 
 class ArchivePDF(object):
@@ -44,10 +47,30 @@ class ArchivePDF(object):
     
     def add(self, filename):
         # type: (str) -> None
-        self._canvas.drawImage(filename, 0, 0, width=self._page_size[0], height=self._page_size[1], preserveAspectRatio=True, anchor='c')
+        self._draw_page(filename)
+    
+    
+    def add_bytes(self, arcname, data):
+        # type: (str, bytes) -> None
+        self._draw_page(ImageReader(get_pdf_page_image(Image.open(io.BytesIO(data)))))
+    
+    
+    def add_image(self, arcname, image):
+        # type: (str, Image) -> None
+        self._draw_page(ImageReader(get_pdf_page_image(image)))
+    
+    
+    def _draw_page(self, image):
+        # type: (str|ImageReader) -> None
+        self._canvas.drawImage(image, 0, 0, width=self._page_size[0], height=self._page_size[1], preserveAspectRatio=True, anchor='c')
         self._canvas.showPage()  # close page
     
     
+    def get_output_path(self):
+        # type: () -> str
+        return self._output_path
+    
+    
     def close(self):
         t0 = time.time()
         self._canvas.save()
@@ -0,0 +1,172 @@
+# Copyright 2011-2019 Alex Yatskov
+# Copyright 2020+     Gabès Jean (naparuba@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Headless batch mode: python -m henskan --output OUT_DIR SERIES_DIR [SERIES_DIR ...]
+# NOTE: do NOT import PyQt6 here (or in anything imported from here), it must run on servers
+
+import argparse
+import os
+import sys
+import time
+import traceback
+
+from .converter import BookConverter
+from .duplicates import DUPLICATE_MODE
+from .grey_palette import GREY_DITHER
+from .image import EReaderData, compare_resample_presets
+from .parameters import parameters, Parameters
+from .resample import RESAMPLE_PRESET
+from .similarity import DELETED_DUMP
+from .util import list_image_files, clean_title, natural_key
+
+SPLIT_MODES = ('none', 'left-right', 'right-left')
+COMPARE_RESAMPLE_PAGES = 5  # pages of each series looked at by --compare-resample
+DEFAULT_CACHE_SIZE_MB = 1024  # the GUI has no cache setting: the cache is only on by default here
+
+
+def _parse_args(argv):
+    # type: (list[str]) -> argparse.Namespace
+    parser = argparse.ArgumentParser(prog='python -m henskan', description='Convert manga/webtoon directories into e-reader books, without UI.')
+    parser.add_argument('paths', nargs='*', help='series directories, each one gives a book (or libraries with --library)')
+    parser.add_argument('-o', '--output', help='directory where the books are written')
+    parser.add_argument('-d', '--device', default=Parameters.DefaultDevice, help=f'device profile (default: {Parameters.DefaultDevice})')
+    parser.add_argument('-s', '--split', choices=SPLIT_MODES, default='none', help='split double pages (default: none)')
+    parser.add_argument('-w', '--webtoon', action='store_true', help='sources are webtoon strips')
+    parser.add_argument('--webtoon-tolerance', type=int, default=0, help='how far from pure white/black (0-255) a webtoon row can be to be cut (default: 0)')
+    parser.add_argument('--grey-sample', type=int, default=0, help='decide if a page is grey from this number of random pixels when it is clear enough (default: 0, all pixels)')
+    parser.add_argument('--fast-decode', action='store_true', help='decode big JPEG sources directly at a reduced size, and grey ones in greyscale: faster, but the auto crop works on fewer pixels, so its box can change by a few pixels')
+    parser.add_argument('--decode-margin', type=float, default=0.25, help='JPEG reduced decode keeps at least this ratio more pixels than the device size (default: 0.25)')
+    parser.add_argument('--grey-dither', choices=[dither.value for dither in GREY_DITHER], default=GREY_DITHER.FLOYD_STEINBERG.value, help=f'dithering of the grey pages into the device palette, {GREY_DITHER.ORDERED.value} and {GREY_DITHER.NONE.value} use the faster lookup tables (default: {GREY_DITHER.FLOYD_STEINBERG.value}, same output as before)')
+    parser.add_argument('--resample', choices=[preset.value for preset in RESAMPLE_PRESET], default=RESAMPLE_PRESET.BEST.value, help=f'resize quality/speed preset (default: {RESAMPLE_PRESET.BEST.value})')
+    parser.add_argument('--compare-resample', action='store_true', help=f'do not convert, but show the time and similarity to "best" of each resize preset on {COMPARE_RESAMPLE_PAGES} pages of each series, for the device')
+    parser.add_argument('--no-passthrough', action='store_true', help='convert all pages, even the ones that already are grey PNG in the device size')
+    parser.add_argument('--smallest-color', action='store_true', help='color pages: keep the smaller PNG of the device palette and the plain grey versions, instead of always the plain grey one')
+    parser.add_argument('--duplicates', choices=[mode.value for mode in DUPLICATE_MODE], default=DUPLICATE_MODE.KEEP.value, help=f'remove the pages that are the same file (exact), or also the ones that look the same (perceptual) as a previous page (default: {DUPLICATE_MODE.KEEP.value})')
+    parser.add_argument('--keep-deleted', action='store_true', help='webtoon: do not remove the dropped blocks images of the previous runs')
+    parser.add_argument('--deleted-dump', choices=[dump.value for dump in DELETED_DUMP], default=DELETED_DUMP.IMAGES.value, help=f'webtoon: what is saved about the dropped blocks, in the deleted directory (default: {DELETED_DUMP.IMAGES.value})')
+    parser.add_argument('-l', '--library', action='store_true', help='paths are libraries: each sub-directory is a series')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of conversion processes (default: number of CPUs)')
+    parser.add_argument('--cache-dir', default=None, help=f'directory of the converted pages cache (default: {parameters.get_cache_directory()})')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE_MB, help=f'max size of the converted pages cache in MB, 0 to disable it (default: {DEFAULT_CACHE_SIZE_MB})')
+    parser.add_argument('--list-devices', action='store_true', help='list the device profiles and exit')
+    return parser.parse_args(argv)
+
+
+def _get_series_directories(paths, is_library):
+    # type: (list[str], bool) -> list[str]
+    series_directories = []
+    for path in paths:
+        if not os.path.isdir(path):
+            print(f'WARNING: {path} is not a directory, skipping it')
+            continue
+        if not is_library:
+            series_directories.append(path)
+            continue
+        sub_directories = [os.path.join(path, name) for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
+        series_directories.extend(sorted(sub_directories, key=natural_key))
+    return series_directories
+
+
+def _convert_series(series_directory, args):
+    # type: (str, argparse.Namespace) -> None
+    image_paths = list_image_files(series_directory)
+    if not image_paths:
+        raise RuntimeError(f'No images found in {series_directory}')
+    
+    parameters.clean()
+    parameters.set_output_directory(args.output)
+    parameters.set_title(clean_title(os.path.basename(os.path.normpath(series_directory))))
+    parameters.set_device(args.device, list(EReaderData.Profiles).index(args.device))
+    parameters.set_is_webtoon(args.webtoon)
+    parameters.set_webtoon_background_tolerance(args.webtoon_tolerance)
+    parameters.set_grey_sample_size(args.grey_sample)
+    parameters.set_fast_decode(args.fast_decode)
+    parameters.set_decode_margin(args.decode_margin)
+    parameters.set_grey_dither(args.grey_dither)
+    parameters.set_resample_preset(args.resample)
+    parameters.set_passthrough(not args.no_passthrough)
+    parameters.set_smallest_color(args.smallest_color)
+    parameters.set_duplicate_mode(args.duplicates)
+    parameters.set_clean_deleted(not args.keep_deleted)
+    parameters.set_deleted_dump(args.deleted_dump)
+    parameters.set_split_left_then_right(args.split == 'left-right')
+    parameters.set_split_right_then_left(args.split == 'right-left')
+    if args.workers is not None:
+        parameters.set_nb_workers(args.workers)
+    if args.cache_dir is not None:
+        parameters.set_cache_directory(args.cache_dir)
+    parameters.set_cache_max_size(args.cache_size * 1024 * 1024)
+    for image_path in image_paths:
+        parameters.add_image(image_path)
+    
+    converter = BookConverter()
+    converter.run()
+
+
+# Pages evenly spread in the series, so the comparison is not only on the covers
+def _compare_resample(series_directory, device):
+    # type: (str, str) -> None
+    image_paths = list_image_files(series_directory)
+    if not image_paths:
+        raise RuntimeError(f'No images found in {series_directory}')
+    step = max(1, len(image_paths) // COMPARE_RESAMPLE_PAGES)
+    sample_paths = image_paths[::step][:COMPARE_RESAMPLE_PAGES]
+    results = compare_resample_presets(sample_paths, EReaderData.get_size(device))
+    for (preset, (total_time, mean_similarity, min_similarity)) in results.items():
+        print(f'  {preset.value:<10} {total_time / len(sample_paths):.3f}s/page  similarity to best: mean={mean_similarity:.4f} min={min_similarity:.4f}')
+
+
+def main(argv=None):
+    # type: (list[str]|None) -> int
+    args = _parse_args(sys.argv[1:] if argv is None else argv)
+    
+    if args.list_devices:
+        for device in EReaderData.Profiles:
+            print(device)
+        return 0
+    
+    if not EReaderData.is_device_exists(args.device):
+        print(f'ERROR: unknown device {args.device}, use --list-devices to see them')
+        return 2
+    
+    if args.compare_resample:
+        for series_directory in _get_series_directories(args.paths, args.library):
+            print(f'Resize presets on {series_directory} for {args.device}:')
+            _compare_resample(series_directory, args.device)
+        return 0
+    
+    if not args.output or not args.paths:
+        print('ERROR: need at least one series directory and --output')
+        return 2
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    
+    series_directories = _get_series_directories(args.paths, args.library)
+    
+    failed = []
+    start = time.time()
+    for (idx, series_directory) in enumerate(series_directories):
+        print(f'[{idx + 1}/{len(series_directories)}] Converting {series_directory}')
+        try:
+            _convert_series(series_directory, args)
+        except Exception:  # one bad book must not stop the whole library
+            print(f'ERROR: cannot convert {series_directory}: {traceback.format_exc()}')
+            failed.append(series_directory)
+    
+    print(f'Converted {len(series_directories) - len(failed)}/{len(series_directories)} books in {time.time() - start:.1f}s')
+    for series_directory in failed:
+        print(f'  FAILED: {series_directory}')
+    return 1 if failed else 0
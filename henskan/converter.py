@@ -0,0 +1,396 @@
+# Copyright 2011-2019 Alex Yatskov
+# Copyright 2020+     Gabès Jean (naparuba@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# NOTE: this module must NOT import PyQt6: it is imported by the pool worker processes
+
+import io
+import os
+import time
+import traceback
+
+from .archive import ARCHIVE_FORMATS
+from .archive_cbz import ArchiveCBZ
+from .archive_pdf import ArchivePDF
+from .duplicates import DUPLICATE_MODE, find_duplicates
+from .image import EReaderData, convert_image_parts, encode_image, is_passthrough_page, is_splitable
+from .page_cache import PageCache
+from .parameters import parameters
+from .pipeline import Pipeline, Stage
+
+
+# One source image, and the page(s) it will give in the archive. A split spread gives 2 parts,
+# in the order they must be in the archive.
+class PageJob(object):
+    def __init__(self, index, source, parts):
+        # type: (int, str, list[tuple[str, bool, bool]]) -> None
+        self.index = index
+        self.source = source
+        self.parts = parts  # (arcname, split_right, split_left)
+        # Filled by the conversion stages
+        self.data = None  # type: bytes|None
+        self.images = []  # (arcname, converted image)
+        self.encoded = []  # (arcname, PNG bytes)
+        self.part_counts = []  # number of images of each part (a webtoon strip gives several)
+        self.cache_keys = []  # one by part
+        self.is_cached = False  # all parts are in the page cache, no need to convert
+        self.is_passthrough = False  # the source goes in the book as is, no need to convert
+
+
+def _get_part_arcnames(arcname, nb_images):
+    # type: (str, int) -> list[str]
+    # If we have only one image, we can directly use the arcname
+    if nb_images == 1:
+        return [arcname]
+    base_arcname = arcname.replace('.png', '')
+    return ['%s_%04d.png' % (base_arcname, idx) for idx in range(nb_images)]
+
+
+# decode + transform: give back the converted images of all parts of the source, with their archive names
+def transform_page(job):
+    # type: (PageJob) -> PageJob
+    print(f'Processing {os.path.split(job.source)[1]}...')
+    
+    # If the pipeline did already read the file, do not read it again
+    source = io.BytesIO(job.data) if job.data is not None else job.source
+    job.images = []
+    job.part_counts = []
+    try:
+        # A split spread is decoded only once for its 2 halves
+        converted_parts = convert_image_parts(source, [(split_right, split_left) for (_, split_right, split_left) in job.parts])
+    except RuntimeError:
+        raise RuntimeError(f'Error while processing {job.source} {traceback.format_exc()}')
+    for ((arcname, split_right, split_left), converted_images) in zip(job.parts, converted_parts):
+        if split_right:
+            print(f"  - Split right {job.source}")
+        if split_left:
+            print(f"  - Split left  {job.source}")
+        print(f"* convert for {job.source} => {arcname}({len(converted_images)})")
+        job.images.extend(zip(_get_part_arcnames(arcname, len(converted_images)), converted_images))
+        job.part_counts.append(len(converted_images))
+    job.data = None  # no need to send it back to the main process
+    return job
+
+
+def encode_page(job):
+    # type: (PageJob) -> PageJob
+    job.encoded = []
+    for (arcname, converted_image) in job.images:
+        try:
+            job.encoded.append((arcname, encode_image(converted_image)))
+        except:
+            print(f'encodePage:: ERROR in encodeImage for {arcname}: {traceback.format_exc()}')
+    job.images = []
+    return job
+
+
+def _need_conversion(job):
+    # type: (PageJob) -> bool
+    return not job.is_cached and not job.is_passthrough
+
+
+def _get_split_side(split_right, split_left):
+    # type: (bool, bool) -> str
+    if split_right:
+        return 'right'
+    if split_left:
+        return 'left'
+    return 'none'
+
+
+# The pool processes do not share the parameters object of the main process, so give them the
+# values convert_image_parts is looking at. The deleted dump is not a conversion option: it does not
+# change the pages, so it is not in the cache keys.
+def _init_pool_process(conversion_options, deleted_dump, deleted_budget):
+    # type: (dict, str, DeletedDumpBudget|None) -> None
+    parameters.set_conversion_options(conversion_options)
+    parameters.set_deleted_dump(deleted_dump)
+    if deleted_budget is not None:  # webtoon: the dropped blocks dumps are capped for the whole run
+        from .similarity import set_deleted_budget
+        set_deleted_budget(deleted_budget)
+
+
+class BookConverter(object):
+    def __init__(self, nb_workers=None, stage_workers=None, queue_size=4):
+        # type: (int|None, dict[str, int]|None, int) -> None
+        self._nb_workers = nb_workers if nb_workers is not None else parameters.get_nb_workers()
+        self._stage_workers = stage_workers or {}  # override the number of workers of a pipeline stage
+        self._queue_size = queue_size
+        self._book_path = ''
+        self._archive = None
+        self._cache = None  # type: PageCache|None
+        self._deleted_budget = None  # type: DeletedDumpBudget|None
+    
+    
+    def get_book_path(self):
+        return self._book_path
+    
+    
+    # Give the page numbers of all images, in the archive order. A split spread takes 2 page numbers, so
+    # all the following pages are shifted
+    def _plan_jobs(self):
+        # type: () -> list[PageJob]
+        jobs = []
+        split_page_offset = 0
+        want_split = parameters.is_split_left_then_right() or parameters.is_split_right_then_left()
+        for (index, source) in enumerate(parameters.get_images()):
+            arcname = '%05d.png' % (index + split_page_offset)
+            # Asked for split: maybe we cannot
+            if want_split and is_splitable(source):  # is image large enough to be split?
+                next_arcname = '%05d.png' % (index + split_page_offset + 1)
+                split_page_offset += 1
+                # Generate 2 images: right, then left
+                if parameters.is_split_right_then_left():
+                    parts = [(arcname, True, False), (next_arcname, False, True)]
+                else:  # just the other order
+                    parts = [(arcname, False, True), (next_arcname, True, False)]
+            else:  # simple page, or un-splitable on a split manga
+                parts = [(arcname, False, False)]
+            jobs.append(PageJob(index, source, parts))
+        return jobs
+    
+    
+    # Before the plan, so the removed pages do not take a page number. The webtoon strips are cut in blocks
+    # that are checked later, so only their exact copies are removed.
+    def _remove_duplicates(self):
+        mode = DUPLICATE_MODE(parameters.get_duplicate_mode())
+        if mode == DUPLICATE_MODE.KEEP:
+            return
+        if mode == DUPLICATE_MODE.PERCEPTUAL and parameters.is_webtoon():
+            mode = DUPLICATE_MODE.EXACT
+        t0 = time.time()
+        image_paths = parameters.get_images()
+        duplicates = find_duplicates(image_paths, mode, self._nb_workers)
+        for (image_path, original_path, distance) in duplicates:
+            how = 'same file as' if distance is None else f'looks like ({distance} bits from)'
+            print(f'BookConverter::run:: removing duplicate {os.path.split(image_path)[1]}: {how} {original_path}')
+        print(f'BookConverter::run:: {len(duplicates)} duplicate pages removed from {len(image_paths)} ({mode.value}) in {time.time() - t0:.2f}s')
+        parameters.remove_images([image_path for (image_path, _, _) in duplicates])
+    
+    
+    def _open_archive(self):
+        device = parameters.get_device()
+        output_format = EReaderData.get_archive_format(device)
+        if ARCHIVE_FORMATS.CBZ == output_format:
+            self._archive = ArchiveCBZ(self._book_path)
+        elif ARCHIVE_FORMATS.PDF == output_format:
+            self._archive = ArchivePDF(self._book_path, parameters.get_title(), device)
+    
+    
+    # The pages go from memory to the archive: the pipeline did already encode them, the serial way
+    # let the archive encode them directly into its file
+    def _add_to_archive(self, job):
+        # type: (PageJob) -> None
+        if self._archive is None:
+            return
+        for (arcname, encoded) in job.encoded:
+            self._archive.add_bytes(arcname, encoded)
+        for (arcname, converted_image) in job.images:
+            try:
+                self._archive.add_image(arcname, converted_image)
+            except:
+                print(f'addToArchive:: ERROR in adding {arcname}: {traceback.format_exc()}')
+        job.encoded = []
+        job.images = []
+    
+    
+    def _open_cache(self):
+        self._cache = None
+        if parameters.get_cache_max_size() <= 0:
+            return
+        try:
+            self._cache = PageCache(parameters.get_cache_directory(), parameters.get_cache_max_size())
+        except OSError:  # no cache is not a reason to not convert
+            print(f'BookConverter::run:: cannot open the page cache, converting without it: {traceback.format_exc()}')
+    
+    
+    # Webtoon blocks are checked against the unwanted images: load them here once, before the workers
+    # start, and not at the first block of a page. Their digest goes in the conversion options, so the
+    # cached pages are converted again when the unwanted images change. The dropped blocks dumps caps
+    # start again at each run.
+    def _prepare_similarity(self):
+        parameters.set_unwanted_digest('')
+        self._deleted_budget = None
+        if not parameters.is_webtoon():
+            return
+        from .similarity import DeletedDumpBudget, clean_deleted_directory, get_similarity, set_deleted_budget
+        if parameters.is_clean_deleted():
+            clean_deleted_directory()
+        self._deleted_budget = DeletedDumpBudget()
+        set_deleted_budget(self._deleted_budget)
+        parameters.set_unwanted_digest(get_similarity(refresh=True).get_unwanted_digest())
+    
+    
+    def _read_page(self, job):
+        # type: (PageJob) -> PageJob
+        with open(job.source, 'rb') as f:
+            job.data = f.read()
+        if self._can_pass_through(job):
+            print(f'Processing {os.path.split(job.source)[1]}... passed through')
+            job.encoded = [(job.parts[0][0], job.data)]
+            job.is_passthrough = True
+            job.data = None
+            return job
+        if self._cache is not None:
+            self._load_from_cache(job)
+        return job
+    
+    
+    # Only a simple page: a split spread or a webtoon strip gives other pages than its source
+    def _can_pass_through(self, job):
+        # type: (PageJob) -> bool
+        if not parameters.is_passthrough() or parameters.is_webtoon() or len(job.parts) != 1:
+            return False
+        (_, split_right, split_left) = job.parts[0]
+        if split_right or split_left:
+            return False
+        return is_passthrough_page(job.data, parameters.get_device())
+    
+    
+    def _load_from_cache(self, job):
+        # type: (PageJob) -> None
+        source_hash = PageCache.hash_source(job.data)
+        conversion_options = parameters.get_conversion_options()
+        job.cache_keys = [PageCache.get_key(source_hash, _get_split_side(split_right, split_left), conversion_options)
+                          for (_, split_right, split_left) in job.parts]
+        encoded = []
+        for ((arcname, _, _), cache_key) in zip(job.parts, job.cache_keys):
+            cached_images = self._cache.get(cache_key)
+            if cached_images is None:  # if one part is missing, convert all, the source is decoded once anyway
+                return
+            encoded.extend(zip(_get_part_arcnames(arcname, len(cached_images)), cached_images))
+        print(f'Processing {os.path.split(job.source)[1]}... from cache')
+        job.encoded = encoded
+        job.is_cached = True
+        job.data = None
+    
+    
+    def _store_page(self, job):
+        # type: (PageJob) -> PageJob
+        # An image that did fail to encode is missing, do not cache a partial page
+        if self._cache is None or job.is_cached or sum(job.part_counts) != len(job.encoded):
+            return job
+        offset = 0
+        for (cache_key, part_count) in zip(job.cache_keys, job.part_counts):
+            self._cache.put(cache_key, [encoded for (_, encoded) in job.encoded[offset:offset + part_count]])
+            offset += part_count
+        return job
+    
+    
+    def _iter_serial(self, jobs):
+        for job in jobs:
+            begin = time.time()
+            self._read_page(job)
+            if not _need_conversion(job):
+                yield job
+                continue
+            transform_page(job)
+            if self._cache is not None:  # need the encoded bytes to cache them
+                self._store_page(encode_page(job))
+            print(f" * Convert in {time.time() - begin:.3f}s for {job.source}")
+            yield job
+    
+    
+    # Decode/transform and encode are CPU bound and run in processes, file reads and cache writes are
+    # I/O and run in threads, all overlapping. Pages found in the cache skip the conversion stages.
+    # The pipeline gives the pages back in the jobs order, so the archive is filled exactly like the serial way.
+    def _iter_pipeline(self, jobs):
+        stage_workers = self._get_stage_workers()
+        pipeline = Pipeline([Stage('read', self._read_page, stage_workers['read']),
+                             Stage('transform', transform_page, stage_workers['transform'], use_processes=True, should_run=_need_conversion),
+                             Stage('encode', encode_page, stage_workers['encode'], use_processes=True, should_run=_need_conversion),
+                             Stage('store', self._store_page, stage_workers['store'], should_run=_need_conversion),
+                             ],
+                            queue_size=self._queue_size,
+                            process_initializer=_init_pool_process,
+                            process_initargs=(parameters.get_conversion_options(), parameters.get_deleted_dump(), self._deleted_budget))
+        for job in pipeline.run(jobs):
+            yield job
+        print(f'BookConverter::run:: pipeline busy time by stage: %s' % (
+            ', '.join(f'{name}={busy_time:.1f}s/{stage_workers[name]}' for (name, busy_time) in pipeline.get_stage_times().items())))
+    
+    
+    # Encoding a page is far quicker than transforming it, so it needs fewer processes
+    def _get_stage_workers(self):
+        # type: () -> dict[str, int]
+        stage_workers = {'read':      2,
+                         'transform': self._nb_workers,
+                         'encode':    max(1, self._nb_workers // 4),
+                         'store':     1,
+                         }
+        stage_workers.update(self._stage_workers)
+        return stage_workers
+    
+    
+    # progress_callback(nb_done, nb_images) is called after each source image is in the archive
+    def run(self, progress_callback=None):
+        directory = parameters.get_output_directory()
+        self._book_path = os.path.join(directory, parameters.get_title())
+        self._archive = None
+        self._open_cache()
+        self._prepare_similarity()
+        
+        # sort images before processing
+        parameters.sort_images()
+        self._remove_duplicates()
+        
+        jobs = self._plan_jobs()
+        nb_images = len(jobs)
+        # Only now: if the planning fails (an image that cannot be read for the split), there is no empty output left
+        self._open_archive()
+        
+        if self._nb_workers > 1 and nb_images > 1:
+            print(f'BookConverter::run:: converting {nb_images} images with {self._nb_workers} processes')
+            results = self._iter_pipeline(jobs)
+        else:
+            results = self._iter_serial(jobs)
+        
+        # Now work!
+        nb_passthrough = 0
+        nb_cached = 0
+        try:
+            for (nb_done, job) in enumerate(results, start=1):
+                nb_passthrough += job.is_passthrough
+                nb_cached += job.is_cached
+                self._add_to_archive(job)
+                if progress_callback is not None:
+                    progress_callback(nb_done, nb_images)
+        except Exception:
+            self._abort()
+            raise
+        print(f'BookConverter::run::Finished processing images: {nb_passthrough} passed through, {nb_cached} from cache, {nb_images - nb_passthrough - nb_cached} converted')
+        
+        # Close the CBZ/PDF
+        if self._archive is not None:
+            self._archive.close()
+        
+        if self._cache is not None:
+            print(f'BookConverter::run:: page cache: %s' % ', '.join(f'{name}={value}' for (name, value) in self._cache.get_stats().items()))
+        if self._deleted_budget is not None:
+            (nb_entries, nb_bytes) = self._deleted_budget.get_usage()
+            print(f'BookConverter::run:: deleted blocks dumps: {nb_entries} entries, {nb_bytes // 1024}KB of images')
+    
+    
+    # A book that failed must not let a truncated CBZ/PDF that looks like a valid one
+    def _abort(self):
+        print(f'BookConverter::run:: conversion failed, removing {self._book_path} outputs')
+        if self._archive is not None:
+            try:
+                self._archive.close()
+            except Exception:
+                print(f'BookConverter::run:: cannot close the archive: {traceback.format_exc()}')
+            output_path = self._archive.get_output_path()
+            if os.path.exists(output_path):
+                os.unlink(output_path)
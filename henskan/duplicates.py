@@ -0,0 +1,141 @@
+# Copyright 2011-2019 Alex Yatskov
+# Copyright 2020+     Gabès Jean (naparuba@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Duplicate pages of a book, found before the conversion: the same file under another name, or (perceptual)
+# the same page saved again, like the credits page at the end of each chapter. The first page in the book
+# order is kept, the next copies are removed.
+# NOTE: this module must NOT import PyQt6: get_perceptual_hash runs in the pool processes
+
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from enum import Enum
+
+import numpy
+from PIL import Image
+
+
+class DUPLICATE_MODE(Enum):
+    KEEP = 'keep'  # all the pages are in the book
+    EXACT = 'exact'  # remove the files with the same content
+    PERCEPTUAL = 'perceptual'  # also the pages that look the same: re-encoded, resized
+
+
+DUPLICATE_HASH_SIZE = 16  # dHash of 16x16 bits
+DUPLICATE_MAX_DISTANCE = 12  # on 256 bits
+DUPLICATE_MIN_DETAIL = 8  # under this number of set bits, the page is almost flat (blank...): only exact copies
+DUPLICATE_MAX_RATIO_DIFF = 0.02  # a page that looks the same must have the same width/height ratio
+DUPLICATE_MIN_PARALLEL = 64  # under this number of images, they are all looked at in this process
+
+
+class PageFingerprint(object):
+    def __init__(self, path, digest):
+        # type: (str, bytes) -> None
+        self.path = path
+        self.digest = digest  # of the file content
+        self.packed_hash = None  # type: numpy.ndarray|None  # dHash bits, None if not perceptual, or not an image we can read
+        self.ratio = 0.0
+
+
+# Difference hash: is each pixel lighter than its right neighbour, on a (size + 1) x size grey thumbnail
+def _get_difference_hash(image):
+    # type: (Image) -> numpy.ndarray
+    image.draft('L', (DUPLICATE_HASH_SIZE * 8, DUPLICATE_HASH_SIZE * 8))  # JPEG: only decode a small version
+    thumbnail = image.convert('L').resize((DUPLICATE_HASH_SIZE + 1, DUPLICATE_HASH_SIZE), Image.Resampling.BOX)
+    pixels = numpy.asarray(thumbnail, dtype=numpy.int16)
+    return numpy.packbits(pixels[:, 1:] > pixels[:, :-1])
+
+
+def get_fingerprint(path):
+    # type: (str) -> PageFingerprint
+    with open(path, 'rb') as f:
+        data = f.read()
+    return PageFingerprint(path, hashlib.blake2b(data, digest_size=16).digest())
+
+
+# Give (dHash bits, width/height ratio), or (None, 0.0) if it is not an image we can read
+def get_perceptual_hash(path):
+    # type: (str) -> tuple[numpy.ndarray|None, float]
+    try:
+        with Image.open(path) as image:
+            return _get_difference_hash(image), image.size[0] / float(image.size[1])
+    except (OSError, ValueError, ZeroDivisionError):  # the conversion will say what is wrong with it
+        return None, 0.0
+
+
+# Reading + hashing the bytes is I/O and hashlib releases the GIL: threads
+def _get_fingerprints(paths, nb_workers):
+    # type: (list[str], int) -> list[PageFingerprint]
+    if nb_workers <= 1 or len(paths) < DUPLICATE_MIN_PARALLEL:
+        return [get_fingerprint(path) for path in paths]
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        return list(executor.map(get_fingerprint, paths))
+
+
+# Decoding for the perceptual hash is CPU bound: processes, if there are enough images to pay for their start
+def _get_perceptual_hashes(paths, nb_workers):
+    # type: (list[str], int) -> list[tuple[numpy.ndarray|None, float]]
+    if nb_workers <= 1 or len(paths) < DUPLICATE_MIN_PARALLEL:
+        return [get_perceptual_hash(path) for path in paths]
+    chunk_size = max(1, len(paths) // (nb_workers * 4))
+    # spawn: do not fork a process that have Qt threads running
+    with ProcessPoolExecutor(max_workers=nb_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(executor.map(get_perceptual_hash, paths, chunksize=chunk_size))
+
+
+# Give the removed pages, in the book order: (path, path of the kept page, distance), distance is None
+# for the same file content
+def find_duplicates(paths, mode, nb_workers=1):
+    # type: (list[str], DUPLICATE_MODE, int) -> list[tuple[str, str, int|None]]
+    if mode == DUPLICATE_MODE.KEEP or len(paths) < 2:
+        return []
+    fingerprints = _get_fingerprints(paths, nb_workers)
+    if mode == DUPLICATE_MODE.PERCEPTUAL:
+        # Only one file of each content is decoded, the exact copies are found without it
+        unique_fingerprints = list({fingerprint.digest: fingerprint for fingerprint in reversed(fingerprints)}.values())
+        perceptual_hashes = _get_perceptual_hashes([fingerprint.path for fingerprint in unique_fingerprints], nb_workers)
+        for (fingerprint, (packed_hash, ratio)) in zip(unique_fingerprints, perceptual_hashes):
+            fingerprint.packed_hash = packed_hash
+            fingerprint.ratio = ratio
+    
+    duplicates = []
+    digests = {}  # digest => path of the kept page
+    # The perceptual hashes of the kept pages, compared all at once to each new page
+    kept_hashes = numpy.zeros((len(fingerprints), DUPLICATE_HASH_SIZE * DUPLICATE_HASH_SIZE // 8), dtype=numpy.uint8)
+    kept_ratios = numpy.zeros(len(fingerprints))
+    kept_paths = []
+    for fingerprint in fingerprints:
+        original_path = digests.get(fingerprint.digest)
+        if original_path is not None:
+            duplicates.append((fingerprint.path, original_path, None))
+            continue
+        digests[fingerprint.digest] = fingerprint.path
+        packed_hash = fingerprint.packed_hash
+        if packed_hash is None or int(numpy.unpackbits(packed_hash).sum()) < DUPLICATE_MIN_DETAIL:
+            continue
+        nb_kept = len(kept_paths)
+        if nb_kept:
+            distances = numpy.unpackbits(kept_hashes[:nb_kept] ^ packed_hash, axis=1).sum(axis=1)
+            distances[numpy.abs(kept_ratios[:nb_kept] - fingerprint.ratio) > DUPLICATE_MAX_RATIO_DIFF * fingerprint.ratio] = DUPLICATE_MAX_DISTANCE + 1
+            best = int(distances.argmin())
+            if distances[best] <= DUPLICATE_MAX_DISTANCE:
+                duplicates.append((fingerprint.path, kept_paths[best], int(distances[best])))
+                digests[fingerprint.digest] = kept_paths[best]  # its exact copies are copies of the kept page
+                continue
+        kept_hashes[nb_kept] = packed_hash
+        kept_ratios[nb_kept] = fingerprint.ratio
+        kept_paths.append(fingerprint.path)
+    return duplicates
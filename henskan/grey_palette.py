@@ -0,0 +1,111 @@
+# Copyright 2011-2019 Alex Yatskov
+# Copyright 2020+     Gabès Jean (naparuba@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# All the device palettes are grey ramps: the palette entry of a pixel only depends on its grey level.
+# So each palette is turned once into 256 entries tables, and a page is a point/array pass on its L
+# data instead of a color nearest neighbour search. This fast path is only for the ordered and none
+# dithers: Floyd-Steinberg (the default) is serial, and still goes through PIL quantize() on RGB, as
+# PIL only quantizes an L image by taking its levels as palette indexes.
+
+from enum import Enum
+
+import numpy
+from PIL import Image
+
+
+class GREY_DITHER(Enum):
+    FLOYD_STEINBERG = 'floyd-steinberg'  # error diffusion, what Image.quantize() does by default: no LUT
+    ORDERED = 'ordered'  # 8x8 Bayer matrix
+    NONE = 'none'  # nearest palette entry
+
+
+def _get_bayer_matrix(size):
+    # type: (int) -> numpy.ndarray
+    matrix = numpy.zeros((1, 1), dtype=numpy.uint8)
+    while matrix.shape[0] < size:
+        matrix = numpy.block([[4 * matrix, 4 * matrix + 2],
+                              [4 * matrix + 3, 4 * matrix + 1]])
+    return matrix
+
+
+_BAYER_SIZE = 8
+_BAYER_MATRIX = _get_bayer_matrix(_BAYER_SIZE)  # thresholds 0 -> 63
+_BAYER_OFFSETS = _BAYER_MATRIX.astype(numpy.uint16) << 8  # threshold * 256: the row of the threshold in the ordered LUT
+
+
+class GreyPalette(object):
+    def __init__(self, palette):
+        # type: (list) -> None
+        colors = len(palette) // 3
+        self.palette = palette + palette[:3] * (256 - colors)  # P images need 256 entries
+        self._palette_image = Image.new('P', (1, 1))
+        self._palette_image.putpalette(self.palette)
+        
+        # Nearest entry of each grey level, from PIL itself so it is exactly what quantize() gives
+        grey_ramp = Image.frombytes('L', (256, 1), bytes(range(256)))
+        self._lut = list(Image.merge('RGB', (grey_ramp, grey_ramp, grey_ramp)).quantize(palette=self._palette_image, dither=Image.Dither.NONE).getdata())
+        
+        # Ordered dither: each grey level is between 2 palette levels, and goes to the upper one when its
+        # position between them is over the Bayer threshold of the pixel
+        level_indexes = {}  # grey level => first palette entry with it
+        for idx in range(colors):
+            level_indexes.setdefault(palette[idx * 3], idx)
+        levels = numpy.array(sorted(level_indexes))
+        grey_values = numpy.arange(256)
+        upper = numpy.clip(numpy.searchsorted(levels, grey_values), 0, len(levels) - 1)  # first level >= value
+        lower = numpy.where(levels[upper] > grey_values, numpy.maximum(upper - 1, 0), upper)
+        spans = numpy.maximum(levels[upper] - levels[lower], 1)
+        fractions = (grey_values - levels[lower]) * (_BAYER_SIZE * _BAYER_SIZE) // spans
+        lower_indexes = numpy.array([level_indexes[level] for level in levels[lower]], dtype=numpy.uint8)
+        upper_indexes = numpy.array([level_indexes[level] for level in levels[upper]], dtype=numpy.uint8)
+        # (threshold, grey level) => palette entry, flat so a page is a single take()
+        thresholds = numpy.arange(_BAYER_SIZE * _BAYER_SIZE)[:, None]
+        self._ordered_lut = numpy.where(fractions[None, :] > thresholds, upper_indexes[None, :], lower_indexes[None, :]).ravel()
+    
+    
+    # Give the P image of the image in this palette
+    def apply(self, image, dither):
+        # type: (Image, GREY_DITHER) -> Image
+        if dither == GREY_DITHER.FLOYD_STEINBERG:
+            # The error diffusion is serial along the rows, so it stays in the PIL C code. An RGB image is
+            # given as is, so the result is the same as before the LUT engine.
+            if image.mode != 'RGB':
+                grey = image if image.mode == 'L' else image.convert('L')
+                image = Image.merge('RGB', (grey, grey, grey))
+            return image.quantize(palette=self._palette_image)
+        
+        grey = image if image.mode == 'L' else image.convert('L')
+        if dither == GREY_DITHER.NONE:
+            result = grey.point(self._lut)
+        else:
+            pixels = numpy.asarray(grey)
+            height, width = pixels.shape
+            offsets = numpy.tile(_BAYER_OFFSETS, (height // _BAYER_SIZE + 1, width // _BAYER_SIZE + 1))[:height, :width]
+            result = Image.fromarray(numpy.take(self._ordered_lut, offsets | pixels))
+        result.putpalette(self.palette)  # L -> P
+        return result
+
+
+_grey_palettes = {}  # type: dict[tuple, GreyPalette]
+
+
+def get_grey_palette(palette):
+    # type: (list) -> GreyPalette
+    key = tuple(palette)
+    grey_palette = _grey_palettes.get(key)
+    if grey_palette is None:
+        grey_palette = _grey_palettes[key] = GreyPalette(palette)
+    return grey_palette
@@ -16,13 +16,16 @@
 import io
 import time
 import traceback
-from enum import Enum
-from math import ceil
+from math import log, sqrt
 
-from PIL import Image, ImageChops, ImageFilter, ImageOps, ImageStat
+import numpy
+from PIL import Image, ImageChops, ImageFilter, ImageOps
 
 from .archive import ARCHIVE_FORMATS
+from .grey_palette import GREY_DITHER, get_grey_palette
+from .page_analysis import COLOR_SATURATION_LIMIT, PIXEL_CATEGORY, PageAnalysis, count_pixel_categories
 from .parameters import parameters
+from .resample import RESAMPLE_PRESET, get_ssim, resample
 
 DEBUG = False
 
@@ -145,6 +148,11 @@ class EReaderData:
         return device in EReaderData.Profiles
 
 
+# The LUT of all device palettes are computed at import, so once by conversion process and not by page
+for _device in EReaderData.Profiles:
+    get_grey_palette(EReaderData.get_palette(_device))
+
+
 # decorate a function that use image, *** and if there
 # is an exception raise by PIL (IOError) then return
 # the original image because PIL cannot manage it
@@ -178,69 +186,67 @@ def _split_right(image):
     return image.crop((width_img // 2, 0, width_img, height_img))
 
 
-class PIXEL_CATEGORY(Enum):
-    WHITE = 1
-    BLACK = 2
-    GREY = 3
-    OTHER = 4
+GREY_MAX_COLORS_PCT = 10  # if 10% of pixels or more are in colors, then it's not grey
+GREY_SAMPLE_CONFIDENCE = 0.001  # max probability that a decision from a sample is not the full scan one
 
 
-def _detect_pixel_category(pixel):
-    # type: (tuple[int, int, int]) -> PIXEL_CATEGORY
-    if pixel[0] >= 255 and pixel[1] >= 255 and pixel[2] >= 255:
-        return PIXEL_CATEGORY.WHITE
-    elif pixel[0] <= 0 and pixel[1] <= 0 and pixel[2] <= 0:
-        return PIXEL_CATEGORY.BLACK
-    elif abs(pixel[0] - pixel[1]) < 10 and abs(pixel[0] - pixel[2]) < 10:  # a diff in 10 (on 255) is ok for "quite the same"
-        return PIXEL_CATEGORY.GREY
-    else:
-        return PIXEL_CATEGORY.OTHER
-
-
-@protect_bad_image
-def _is_globally_grey__slow(image):
-    # type: (Image) -> bool
-    pixels = image.getdata()
-    
-    nb_pixels = len(pixels)
-    nb_pixels_in_colors_over_threshold = nb_pixels * 0.1  # if more than 10% of pixels are in colors, then it's not grey and we can stop the loop
-    nb_pixels_in_colors = 0
-    cats = {}
-    for pixel in pixels:
-        cat = _detect_pixel_category(pixel)
-        if cat not in cats:
-            cats[cat] = 0
-        cats[cat] += 1
-        if cat == PIXEL_CATEGORY.OTHER:
-            nb_pixels_in_colors += 1
-            if nb_pixels_in_colors > nb_pixels_in_colors_over_threshold:
-                print(f' too many pixels in colors, over 10%: {nb_pixels_in_colors} / {nb_pixels}')
-                return False
-    print(f' cats: {cats}')
-    total_pixels = cats.get(PIXEL_CATEGORY.WHITE, 0) + cats.get(PIXEL_CATEGORY.BLACK, 0) + cats.get(PIXEL_CATEGORY.GREY, 0) + cats.get(
-            PIXEL_CATEGORY.OTHER, 0)
-    nb_others = cats.get(PIXEL_CATEGORY.OTHER, 0)
-    pct_colors = nb_others / total_pixels * 100
+def _is_globally_grey(category_counts):
+    # type: (dict[PIXEL_CATEGORY, int]) -> bool
+    total_pixels = sum(category_counts.values())
+    pct_colors = category_counts[PIXEL_CATEGORY.OTHER] / total_pixels * 100
     print(f' pct_colors: {pct_colors:.2f}%')
-    is_grey = pct_colors < 10  # if less than 10% of colors, then it's mostly grey
+    is_grey = pct_colors < GREY_MAX_COLORS_PCT  # if less than 10% of colors, then it's mostly grey
     return is_grey
 
 
+# Random pixels, but always the same for the same image size
+def _get_sampled_pixel_categories(image, sample_size):
+    # type: (Image, int) -> dict[PIXEL_CATEGORY, int]
+    pixels = numpy.asarray(image if image.mode == 'RGB' else image.convert('RGB')).reshape(-1, 3)
+    if len(pixels) > sample_size:
+        pixels = pixels[numpy.random.default_rng(len(pixels)).integers(0, len(pixels), sample_size)]
+    return count_pixel_categories(pixels)
+
+
+# For diagnostics: the category counts of all pixels, or of a sample of them
+def get_pixel_categories(image, sample_size=0):
+    # type: (Image, int) -> dict[PIXEL_CATEGORY, int]
+    if sample_size > 0:
+        return _get_sampled_pixel_categories(image, sample_size)
+    return PageAnalysis(image).get_category_counts()
+
+
+# Decide from a sample only when it is far from the limit: by Hoeffding, the colors ratio of a sample is
+# farther than margin from the real one with less than GREY_SAMPLE_CONFIDENCE probability.
+# None if it is too near the limit (or the image is not bigger than the sample): the full scan must decide.
+def _is_globally_grey__sampled(image, sample_size):
+    # type: (Image, int) -> bool|None
+    if image.size[0] * image.size[1] <= sample_size:
+        return None
+    category_counts = _get_sampled_pixel_categories(image, sample_size)
+    colors_ratio = category_counts[PIXEL_CATEGORY.OTHER] / sample_size
+    margin = sqrt(log(2 / GREY_SAMPLE_CONFIDENCE) / (2 * sample_size))
+    if colors_ratio + margin < GREY_MAX_COLORS_PCT / 100:
+        return True
+    if colors_ratio - margin >= GREY_MAX_COLORS_PCT / 100:
+        return False
+    return None
+
+
 # Check if image is monochrome (1 channel or 3 identical channels)
 @protect_bad_image
-def _is_totally_greyscale__fast(image):
-    # type: ( Image) -> bool
+def _is_totally_greyscale__fast(image, analysis):
+    # type: (Image, PageAnalysis) -> bool
     if image.mode not in ("L", "RGB"):
         # Unsupported image mode
         return False
     
     if image.mode == "RGB":
-        rgb = image.split()
-        extrema = ImageChops.difference(rgb[0], rgb[1]).getextrema()[1]
+        extrema = analysis.red_green_difference_max
         print(f' extrema 1?  {extrema}')
         if extrema >= 15:
             return False
-        extrema = ImageChops.difference(rgb[0], rgb[2]).getextrema()[1]
+        extrema = analysis.red_blue_difference_max
         print(f' extrema 2?  {extrema}')
         if extrema >= 15:
             return False
@@ -250,14 +256,26 @@ def _is_totally_greyscale__fast(image):
 @protect_bad_image
 def _is_image_grey(image):
     # type: (Image) -> bool
+    if image.mode == 'L':  # _format_image_mode did already say it was grey
+        return True
     before = time.time()
-    is_grey = _is_totally_greyscale__fast(image)  # if True, then we can trust it's grey
+    # If asked, a sample of the pixels can already say it is grey, without a look at all the pixels
+    sample_size = parameters.get_grey_sample_size()
+    sampled_is_grey = None
+    if sample_size > 0 and image.mode == 'RGB':
+        sampled_is_grey = _is_globally_grey__sampled(image, sample_size)
+        print(f'{time.time() - before:.2f} SAMPLED DETECT COLORS => is_grey: {sampled_is_grey}')
+        if sampled_is_grey:  # the fast check cannot say otherwise
+            return True
+    
+    analysis = PageAnalysis(image)  # the device sized image, it is what the palette will be applied on
+    is_grey = _is_totally_greyscale__fast(image, analysis)  # if True, then we can trust it's grey
     print(f'{time.time() - before:.2f} GREYSCALE Image FAST => is_grey: {is_grey}')
     
-    if not is_grey:  # maybe it's a grey with a little bit of colors, so must check for real colors presence
+    if not is_grey and sampled_is_grey is None:  # maybe it's a grey with a little bit of colors, so must check for real colors presence
         before_slow = time.time()
-        is_grey = _is_globally_grey__slow(image)
-        print(f'  {time.time() - before_slow:.2f} SLOW DETECT COLORS => is_grey: {is_grey}')
+        is_grey = _is_globally_grey(analysis.get_category_counts())
+        print(f'  {time.time() - before_slow:.2f} FULL DETECT COLORS => is_grey: {is_grey}')
         if is_grey:
             print(f'  *********** WAS IN FACT GREY ***********')
     return is_grey
@@ -266,15 +284,7 @@ def _is_image_grey(image):
 @protect_bad_image
 def _apply_grey_palette(image, palette):
     # type: (Image, list) -> Image
-    
-    colors = len(palette) // 3
-    if colors < 256:
-        palette = palette + palette[:3] * (256 - colors)
-    
-    pal_img = Image.new('P', (1, 1))
-    pal_img.putpalette(palette)
-    
-    return image.quantize(palette=pal_img)
+    return get_grey_palette(palette).apply(image, GREY_DITHER(parameters.get_grey_dither()))
 
 
 @protect_bad_image
@@ -284,9 +294,33 @@ def _apply_basic_grey(image):
     return ImageOps.grayscale(image)
 
 
+QUANTIZE_PROBE_BAND_HEIGHT = 16  # the size probe keeps 1 band of 16 rows out of 8: PNG rows compress with their neighbours
+QUANTIZE_PROBE_EVERY = 8
+QUANTIZE_CHECK_RATIO = 0.05  # part of the pages where the probe choice is checked against the full encodes
+
+
+def _get_png_size(image, compress_level=6):
+    # type: (Image, int) -> int
+    with io.BytesIO() as f:
+        image.save(f, format='PNG', compress_level=compress_level)
+        return len(f.getvalue())
+
+
+# Size of a fast (level 1) PNG of bands of rows of the image: much smaller and quicker than the real encode,
+# but the ratio between 2 versions of a page is about the same
+def _get_probe_png_size(image):
+    # type: (Image) -> int
+    pixels = numpy.asarray(image)
+    keep = (numpy.arange(pixels.shape[0]) // QUANTIZE_PROBE_BAND_HEIGHT) % QUANTIZE_PROBE_EVERY == 0
+    probe = Image.fromarray(pixels[keep])
+    if image.mode == 'P':
+        probe.putpalette(image.getpalette())
+    return _get_png_size(probe, compress_level=1)
+
+
 @protect_bad_image
-def _quantize_image(image, palette):
-    # type: (Image, list) -> Image
+def _quantize_image(image, palette, check_ratio=QUANTIZE_CHECK_RATIO):
+    # type: (Image, list, float) -> Image
     
     t0 = time.time()
     img_palette = _apply_grey_palette(image, palette)
@@ -294,38 +328,40 @@ def _quantize_image(image, palette):
     img_basic_grey = _apply_basic_grey(image)
     t2 = time.time()
     
-    # Get image that is smaller in disk size
-    
-    # Save both images to buffers
-    with io.BytesIO() as temp_palette_file:
-        img_palette.save(temp_palette_file, format='PNG')
-        palette_file_size = len(temp_palette_file.getvalue())
+    # Get image that is smaller in disk size, predicted from the probes instead of 2 full encodes
+    palette_probe_size = _get_probe_png_size(img_palette)
+    basic_probe_size = _get_probe_png_size(img_basic_grey)
+    is_palette_smaller = palette_probe_size < basic_probe_size
     t3 = time.time()
     
-    with io.BytesIO() as temp_basic_file:
-        img_basic_grey.save(temp_basic_file, format='PNG')
-        basic_file_size = len(temp_basic_file.getvalue())
-    t4 = time.time()
+    print(f'Times: Palette:{t1 - t0:.3f}s  Basic:{t2 - t1:.3f}s  Probes:{t3 - t2:.3f}s')
+    print(f'Probe sizes: Palette:{palette_probe_size}  Basic:{basic_probe_size}')
     
-    print(f'Times: Palette:{t1 - t0:.3f}s  Basic:{t2 - t1:.3f}s  Save-palette:{t3 - t2:.3f}s  Save-basic:{t4 - t3:.3f}s')
-    print(f'Sizes: Palette:{palette_file_size}  Basic:{basic_file_size}')
+    # From time to time, look if the full encodes would have done the same choice. The draw is seeded by the
+    # probes, so a page gets the same choice at each conversion (and the same page cache entry)
+    if numpy.random.default_rng(palette_probe_size * 1000003 + basic_probe_size).random() < check_ratio:
+        palette_file_size = _get_png_size(img_palette)
+        basic_file_size = _get_png_size(img_basic_grey)
+        is_agreeing = is_palette_smaller == (palette_file_size < basic_file_size)
+        print(f' * Quantize image => check on full encodes: Palette:{palette_file_size}  Basic:{basic_file_size}  probe {"agrees" if is_agreeing else "DISAGREES"} (in {time.time() - t3:.3f}s)')
+        is_palette_smaller = palette_file_size < basic_file_size
     
     # Get smaller one
-    if palette_file_size < basic_file_size:
+    if is_palette_smaller:
         print(f' * Quantize image => Using palette image')
         return img_palette
     print(f' * Quantize image => Using basic grey image')
     return img_basic_grey
 
 
-@protect_bad_image
-def _resize_image(image, size):
-    # type: (Image, tuple[int, int]) -> Image
+# The size that fits in the device one, with the image ratio (the image size if it already fits)
+def _get_resized_size(image_size, size):
+    # type: (tuple[int, int], tuple[int, int]) -> tuple[int, int]
     width_dev, height_dev = size
-    width_img, height_img = image.size
+    width_img, height_img = image_size
     
     if width_img <= width_dev and height_img <= height_dev:
-        return image
+        return image_size
     
     ratio_img = float(width_img) / float(height_img)
     ratio_width = float(width_img) / float(width_dev)
@@ -339,11 +375,20 @@ def _resize_image(image, size):
         width_img = int(height_dev * ratio_img)
     else:
         width_img, height_img = size
+    return width_img, height_img
+
+
+@protect_bad_image
+def _resize_image(image, size):
+    # type: (Image, tuple[int, int]) -> Image
+    width_img, height_img = _get_resized_size(image.size, size)
+    if (width_img, height_img) == image.size:
+        return image
     
     if DEBUG:
         print(' * Resizing image from %s to %s/%s' % (image.size, width_img, height_img))
     
-    return image.resize((width_img, height_img), Image.Resampling.LANCZOS)
+    return resample(image, (width_img, height_img), RESAMPLE_PRESET(parameters.get_resample_preset()))
 
 
 @protect_bad_image
@@ -355,15 +400,45 @@ def _format_image_to_rgb(image):
     return image.convert('RGB')
 
 
+SINGLE_CHANNEL_MODES = ('1', 'L', 'LA', 'I', 'I;16', 'F')  # grey by nature (LA alpha is dropped as by the RGB conversion)
+GREY_SOURCE_REDUCE = 4  # the grey source detection looks at a 1/4 box reduced copy of the source
+
+
+# Same rules as _is_image_grey, but on the source (reduced): a grey one can run all the stages in L
 @protect_bad_image
-def _orient_image(image, device_size):
-    # type: (Image, tuple[int, int]) -> Image
-    width_dev, height_dev = device_size
-    width_img, height_img = image.size
-    
-    if (width_img > height_img) != (width_dev > height_dev):
-        return image.rotate(90, Image.Resampling.LANCZOS, True)
-    return image
+def _is_grey_source(image):
+    # type: (Image) -> bool
+    proxy = image.reduce(GREY_SOURCE_REDUCE) if min(image.size) >= GREY_SOURCE_REDUCE else image
+    analysis = PageAnalysis(proxy)
+    if _is_totally_greyscale__fast(proxy, analysis):
+        return True
+    return _is_globally_grey(analysis.get_category_counts())
+
+
+# All the channels are equal: the L conversion gives the same values than each of them
+def _is_pure_grey(image):
+    # type: (Image) -> bool
+    red, green, blue = image.split()
+    return ImageChops.difference(red, green).getbbox() is None and ImageChops.difference(red, blue).getbbox() is None
+
+
+# Grey sources (most of the manga pages) go in L mode, a third of the pixels to rotate and resize than
+# in RGB. Only the color ones stay in RGB, for the grey decision on the device sized image. For pure grey
+# RGB sources (all channels equal), the converted page is exactly the same than with the RGB way.
+# Give (image, image to compute the auto crop on): the crop looks at the first band and at the ink of all
+# the bands, so for a grey source with some color pixels it is computed on the RGB image, as before the L mode.
+@protect_bad_image
+def _format_image_mode(image):
+    # type: (Image) -> tuple[Image, Image]
+    if image.mode in SINGLE_CHANNEL_MODES:
+        image = image if image.mode == 'L' else image.convert('L')
+        return image, image
+    image = _format_image_to_rgb(image)
+    if _is_grey_source(image):
+        print(f' * Grey source => L mode')
+        grey_image = image.convert('L')
+        return grey_image, grey_image if _is_pure_grey(image) else image
+    return image, image
 
 
 # We will auto crop the image, by removing just white part around the image
@@ -371,7 +446,14 @@ def _orient_image(image, device_size):
 @protect_bad_image
 def _blurauto_crop_image(image):
     # type: (Image) -> Image
-    orig_image = image
+    blur_bbox = _get_blur_crop_box(image)
+    if blur_bbox:
+        return image.crop(blur_bbox)
+    return image
+
+
+def _get_blur_crop_box(image):
+    # type: (Image) -> tuple[int, int, int, int]|None
     power = 2.0  # mode: pifometre
     # work on a black image
     blur_image = ImageOps.invert(image.convert(mode='L'))
@@ -379,10 +461,7 @@ def _blurauto_crop_image(image):
     blur_image = blur_image.filter(ImageFilter.MinFilter(size=3))
     blur_image = blur_image.filter(ImageFilter.GaussianBlur(radius=5))
     blur_image = blur_image.point(lambda x: (x >= 16 * power) and x)
-    blur_bbox = blur_image.getbbox()
-    if blur_bbox:
-        return orig_image.crop(blur_bbox)
-    return orig_image
+    return blur_image.getbbox()
 
 
 def _find_dominant_color(img):
@@ -399,65 +478,70 @@ def _find_dominant_color(img):
     return dominant_color
 
 
-def _get_image_variance(image):
-    # type: (Image) -> float
-    return ImageStat.Stat(image).var[0]
-
-
 @protect_bad_image
 def _auto_crop_image(image):
     # type: (Image) -> Image
+    box = _get_auto_crop_box(image)
+    if box == (0, 0) + image.size:
+        return image
+    return image.crop(box)
+
+
+# The box of the image the auto crop keeps: only boxes are computed, the pixels are copied once by the caller
+def _get_auto_crop_box(image):
+    # type: (Image) -> tuple[int, int, int, int]
     fixed_threshold = 5.0
     
     before = time.time()
     
-    if ImageChops.invert(image).getbbox() is None:
+    # All the bands variances and the bbox are read from it: no crop to compute a variance
+    width, height = image.size
+    analysis = PageAnalysis(image)
+    if analysis.bbox is None:
         if DEBUG:
             print(' * autoCropImage => Using simpleCropImage because no bbox')
-        image = _simple_crop_image(image)
-        return image
+        return 0, 0, width, height
     
-    width, height = image.size
     delta = 2
     diff = delta
-    if _get_image_variance(image) < 2 * fixed_threshold:
+    image_variance = analysis.get_variance()
+    if image_variance < 2 * fixed_threshold:
         if DEBUG:
             print(' * autoCropImage => Image variance is already too small, give back image')
-        image = _simple_crop_image(image)
-        return image
+        return analysis.bbox  # the simple crop
     
-    while _get_image_variance(image.crop((0, height - diff, width, height))) < fixed_threshold and diff < height:
+    while analysis.get_rows_variance(height - diff, height) < fixed_threshold and diff < height:
         diff += delta
     diff -= delta
     page_number_cut1 = diff
     if diff < delta:
         diff = delta
-    old_stat = _get_image_variance(image.crop((0, height - diff, width, height)))
+    old_stat = analysis.get_rows_variance(height - diff, height)
     diff += delta
-    while _get_image_variance(image.crop((0, height - diff, width, height))) - old_stat > 0 and diff < height // 4:
-        old_stat = _get_image_variance(image.crop((0, height - diff, width, height)))
+    while analysis.get_rows_variance(height - diff, height) - old_stat > 0 and diff < height // 4:
+        old_stat = analysis.get_rows_variance(height - diff, height)
         diff += delta
     diff -= delta
     page_number_cut2 = diff
     diff += delta
-    old_stat = _get_image_variance(image.crop((0, height - diff, width, height - page_number_cut2)))
-    while _get_image_variance(image.crop((0, height - diff, width, height - page_number_cut2))) < fixed_threshold + old_stat and diff < height // 4:
+    old_stat = analysis.get_rows_variance(height - diff, height - page_number_cut2)
+    while analysis.get_rows_variance(height - diff, height - page_number_cut2) < fixed_threshold + old_stat and diff < height // 4:
         diff += delta
     diff -= delta
     page_number_cut3 = diff
     delta = 5
     diff = delta
-    while _get_image_variance(image.crop((0, height - page_number_cut2, diff, height))) < fixed_threshold and diff < width:
+    while analysis.get_box_variance(0, height - page_number_cut2, diff, height) < fixed_threshold and diff < width:
         diff += delta
     diff -= delta
     page_number_x1 = diff
     diff = delta
-    while _get_image_variance(image.crop((width - diff, height - page_number_cut2, width, height))) < fixed_threshold and diff < width:
+    while analysis.get_box_variance(width - diff, height - page_number_cut2, width, height) < fixed_threshold and diff < width:
         diff += delta
     diff -= delta
     page_number_x2 = width - diff
     if page_number_cut3 - page_number_cut1 > 2 * delta and float(page_number_x2 - page_number_x1) / float(page_number_cut2 - page_number_cut1) <= 9.0 \
-            and _get_image_variance(image.crop((0, height - page_number_cut3, width, height))) / ImageStat.Stat(image).var[0] < 0.1 \
+            and analysis.get_rows_variance(height - page_number_cut3, height) / image_variance < 0.1 \
             and page_number_cut3 < height // 4 - delta:
         diff = page_number_cut3
     else:
@@ -467,32 +551,65 @@ def _auto_crop_image(image):
         print(' * autoCropImage:: Computing crop diff to %s (in %.3f)' % (diff, time.time() - before))
         image.save('tmp/1_before_crop.png')
     
-    before = time.time()
-    image = image.crop((0, 0, width, height - diff))
-    if DEBUG:
-        print(' * autoCropImage:: apply crop to %s (in %.3f)' % (diff, time.time() - before))
-        image.save('tmp/2_after_crop.png')
+    # The simple crop of the cropped image is the bbox of the ink of the kept rows
+    box = analysis.get_ink_bbox(0, height - diff)
+    if box is None:
+        box = (0, 0, width, height - diff)
     
+    # The blur looks at the cropped image only: its borders are the crop ones
     before = time.time()
-    image = _simple_crop_image(image)
+    blur_bbox = _get_blur_crop_box(image.crop(box))
+    if blur_bbox:
+        box = (box[0] + blur_bbox[0], box[1] + blur_bbox[1], box[0] + blur_bbox[2], box[1] + blur_bbox[3])
     if DEBUG:
-        print(' * autoCropImage:: simple crop to %s in %.3f' % (image.size, time.time() - before))
-        image.save('tmp/3_after_simple_crop.png')
+        print(' * autoCropImage:: crop to %s after blurauto (in %.3f)' % (str(box), time.time() - before))
+        image.crop(box).save('tmp/4_after_auto_blur.png')
     
-    before = time.time()
-    image = _blurauto_crop_image(image)
-    if DEBUG:
-        print(' * autoCropImage:: Blurauto %s in %.3f' % (image.size, time.time() - before))
-        image.save('tmp/4_after_auto_blur.png')
+    return box
+
+
+# Auto crop, orient and resize as one geometric stage. The crop is only the box of the resample, so there is
+# a single LANCZOS pass from the source without a full size copy, and the 90° rotation is a lossless transpose
+# of the device sized image, not of the source.
+@protect_bad_image
+def _crop_orient_resize_image(image, size, crop_image=None):
+    # type: (Image, tuple[int, int], Image|None) -> Image
+    box = _get_auto_crop_box(crop_image if crop_image is not None else image)
+    return _orient_resize_box(image, box, size, RESAMPLE_PRESET(parameters.get_resample_preset()))
+
+
+def _orient_resize_box(image, box, size, preset):
+    # type: (Image, tuple[int, int, int, int], tuple[int, int], RESAMPLE_PRESET) -> Image
+    box_width, box_height = box[2] - box[0], box[3] - box[1]
+    width_dev, height_dev = size
     
+    # Always Orient based the size: if too large, go paysage
+    is_rotated = (box_width > box_height) != (width_dev > height_dev)
+    if is_rotated:
+        height_img, width_img = _get_resized_size((box_height, box_width), size)
+    else:
+        width_img, height_img = _get_resized_size((box_width, box_height), size)
+    
+    if (width_img, height_img) != (box_width, box_height):
+        if DEBUG:
+            print(' * Resizing box %s of %s to %s/%s' % (str(box), image.size, width_img, height_img))
+        image = resample(image, (width_img, height_img), preset, box=box)
+    elif box != (0, 0) + image.size:
+        image = image.crop(box)
+    
+    if is_rotated:
+        image = image.transpose(Image.Transpose.ROTATE_90)
     return image
 
 
 @protect_bad_image
-def _simple_crop_image(image):
-    # type: (Image) -> Image
+def _simple_crop_image(image, analysis=None):
+    # type: (Image, PageAnalysis|None) -> Image
+    bbox = analysis.bbox if analysis is not None else ImageChops.invert(image).getbbox()
+    if bbox is None:  # nothing but white
+        return image
     try:
-        x0, y0, xend, yend = ImageChops.invert(image).getbbox()
+        x0, y0, xend, yend = bbox
     except TypeError:  # bad image, specific to chops
         return image
     image = image.crop((x0, y0, xend, yend))
@@ -549,211 +666,215 @@ def __get_image_width(image):
 
 WHITE_PIXEL = (255, 255, 255)
 
+WEBTOON_SCAN_CHUNK_PIXELS = 4 * 1024 * 1024  # rows are classified by chunks of this, so a 800x60000 strip is not all copied at once
+
+
+# Give for each row of the image if it is only background, so if we can cut the strip here:
+# * white background: all pixels are white
+# * black background: all pixels are quite black or white
+# The tolerance is how far from pure white/black a pixel can be, for tinted or JPEG-noisy backgrounds
+def _get_background_rows(image, is_black_background, tolerance=0):
+    # type: (Image, bool, int) -> numpy.ndarray
+    image_rgb = image if image.mode == 'RGB' else image.convert('RGB')
+    pixels = numpy.asarray(image_rgb)  # height x width x 3
+    height, width = pixels.shape[:2]
+    background_rows = numpy.empty(height, dtype=bool)
+    chunk_height = max(1, WEBTOON_SCAN_CHUNK_PIXELS // max(1, width))
+    for start in range(0, height, chunk_height):
+        chunk = pixels[start:start + chunk_height]
+        if not is_black_background:
+            background_rows[start:start + chunk_height] = chunk.reshape(len(chunk), -1).min(axis=1) >= 255 - tolerance
+            continue
+        is_background = chunk.min(axis=2) >= 255 - tolerance
+        is_background |= chunk.max(axis=2) <= QUITE_BLACK_LIMIT + tolerance
+        background_rows[start:start + chunk_height] = is_background.all(axis=1)
+    return background_rows
+
+
+FULL_BACKGROUND_PROXY_MIN_PIXELS = 256 * 1024  # bigger images are first looked at on a reduced copy
+FULL_BACKGROUND_PROXY_FACTOR = 8
+
+
+def _is_all_background(pixels, is_white, precision):
+    # type: (numpy.ndarray, bool, int) -> bool
+    if is_white:
+        return int(pixels.min(initial=255)) >= 255 - precision
+    return int(pixels.max(initial=0)) <= precision
+
 
 # Remove images that are full white or full black
 def _is_full_background_image(image):
     # type: (Image) -> bool
     precision = 5
-    image_rgb = image.convert('RGB')
-    height = __get_image_height(image)
-    width = __get_image_width(image)
-    pixels = image_rgb.load()
-    start_pixel = pixels[0, 0]
+    image_rgb = image if image.mode == 'RGB' else image.convert('RGB')
+    start_pixel = image_rgb.getpixel((0, 0))
     is_white = _is_quite_white(start_pixel, precision=precision)
     is_black = _is_quite_black(start_pixel, precision=precision)
     if DEBUG:
         print('  is_full_background_image:: white=%s   black=%s' % (is_white, is_black))
-    if is_white:
-        for x in range(width):
-            for y in range(height):
-                pixel = pixels[x, y]
-                if not _is_quite_white(pixel, precision=precision):
-                    if DEBUG:
-                        print('    is_full_background_image:: the pixel %s/%s is not white %s-%s-%s' % (x, y, pixel[0], pixel[1], pixel[2]))
-                    return False
-        # all was white
-        return True
-    if is_black:
-        for x in range(width):
-            for y in range(height):
-                pixel = pixels[x, y]
-                if not _is_quite_black(pixel, precision=precision):
-                    if DEBUG:
-                        print('    is_full_background_image:: the pixel %s/%s is not black %s-%s-%s' % (x, y, pixel[0], pixel[1], pixel[2]))
-                    return False
-        # all was black
-        return True
+    if not is_white and not is_black:  # First pixel was not white or black
+        return False
     
-    # First pixel was not white or black
-    return False
+    # The average of a box is out of the background only if one of its pixels is: the reduced copy
+    # can say no, but only the full image can say yes
+    width, height = image_rgb.size
+    if width * height >= FULL_BACKGROUND_PROXY_MIN_PIXELS:
+        proxy = image_rgb.reduce(FULL_BACKGROUND_PROXY_FACTOR)
+        if not _is_all_background(numpy.asarray(proxy), is_white, precision):
+            if DEBUG:
+                print('    is_full_background_image:: the reduced image is not all %s' % ('white' if is_white else 'black'))
+            return False
+    
+    is_full_background = _is_all_background(numpy.asarray(image_rgb), is_white, precision)
+    if DEBUG and not is_full_background:
+        print('    is_full_background_image:: a pixel is not %s' % ('white' if is_white else 'black'))
+    return is_full_background
 
 
-def __fail_back_to_cut_very_big_one(image):
-    # type: (Image) -> list[Image]
-    image_height = __get_image_height(image)
-    image_width = __get_image_width(image)
+# The pixels that can be crossed by a cut line (same test as _is_background_pixel, precision=10)
+def _get_background_mask(pixels, is_black_background, precision=10):
+    # type: (numpy.ndarray, bool, int) -> numpy.ndarray
+    if is_black_background:
+        return pixels.max(axis=2) <= precision
+    return pixels.min(axis=2) >= 255 - precision
+
+
+def _get_mask_bbox(mask):
+    # type: (numpy.ndarray) -> tuple[int, int, int, int]|None
+    rows = numpy.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    columns = numpy.flatnonzero(mask.any(axis=0))
+    return int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+
+
+# Too high and no line to cut: cut each HARD_MAX_BLOC_HEIGHT window at its row with the less ink
+def __fail_back_to_cut_very_big_one(pixels, background):
+    # type: (numpy.ndarray, numpy.ndarray) -> list[Image]
+    image_height, image_width = background.shape
     print("__fail_back_to_cut_very_big_one:: %s" % image_height)
     if image_height <= HARD_MAX_BLOC_HEIGHT:
-        return [image]
+        return [Image.fromarray(pixels)]
     
+    row_inks = image_width - background.sum(axis=1)  # number of not background pixels by row
     hard_split_images = []
-    nb_images = int(ceil(float(image_height) / HARD_MAX_BLOC_HEIGHT))
-    
-    for idx in range(nb_images):
-        hard_split = image.crop((0, idx * HARD_MAX_BLOC_HEIGHT, image_width, (idx + 1) * HARD_MAX_BLOC_HEIGHT))
-        hard_split_images.append(hard_split)
+    top = 0
+    while image_height - top > HARD_MAX_BLOC_HEIGHT:
+        window_start = top + HARD_MAX_BLOC_HEIGHT // 2
+        window = row_inks[window_start:top + HARD_MAX_BLOC_HEIGHT + 1]
+        # the last of the lowest ink rows, so the parts are as high as possible
+        cut_y = window_start + len(window) - 1 - int(numpy.argmin(window[::-1]))
+        hard_split_images.append(Image.fromarray(pixels[top:cut_y]))
+        top = cut_y
+    hard_split_images.append(Image.fromarray(pixels[top:]))
     print("__fail_back_to_cut_very_big_one:: cut into %s parts" % len(hard_split_images))
     return hard_split_images
 
 
+SMART_SPLIT_SLOPES = (0, 1)  # pixels up by pixel across of the tested cut lines: horizontal, then 45°
+SMART_SPLIT_CHUNK = 256  # candidate rows tested at once
+
+
+# Look for the first row y (from 500, each 10 rows) where a straight line crosses only background pixels.
+# The line can start at the left and go up to the right, or start at the right (on a split_pixel) and go up
+# to the left. Give back the y of the line for each x, or None
+def __find_smart_cut_line(background, is_split_pixel):
+    # type: (numpy.ndarray, numpy.ndarray) -> numpy.ndarray|None
+    image_height, image_width = background.shape
+    xs = numpy.arange(image_width)
+    # (from left, offsets to remove from y for each x), in the order they are preferred
+    line_shapes = [(True, numpy.ceil(xs * slope).astype(numpy.int64)) for slope in SMART_SPLIT_SLOPES]
+    line_shapes += [(False, numpy.ceil((image_width - xs) * slope).astype(numpy.int64)) for slope in SMART_SPLIT_SLOPES]
+    
+    candidates = numpy.arange(500, image_height - 200, 10)  # do not try to cut too early, it's useless
+    for chunk_start in range(0, len(candidates), SMART_SPLIT_CHUNK):
+        ys = candidates[chunk_start:chunk_start + SMART_SPLIT_CHUNK]
+        left_found = numpy.zeros(len(ys), dtype=bool)
+        found_offsets = [None] * len(ys)
+        for (from_left, offsets) in line_shapes:
+            if from_left:
+                can_start = background[ys, 0]
+            else:  # only if the left did fail
+                can_start = is_split_pixel[ys, image_width - 1] & ~left_found
+            line_ys = ys[:, None] - offsets[None, :]
+            is_valid = can_start & (line_ys > 0).all(axis=1)
+            is_valid &= background[numpy.maximum(line_ys, 0), xs[None, :]].all(axis=1)
+            for idx in numpy.flatnonzero(is_valid):
+                if found_offsets[idx] is None:
+                    found_offsets[idx] = offsets
+            if from_left:
+                left_found |= is_valid
+        for (idx, offsets) in enumerate(found_offsets):
+            if offsets is not None:
+                print("Yeah, we can cut from %s" % ys[idx])
+                return ys[idx] - offsets
+    return None
+
+
 # We have a block image that is too big, try to see if with linear cut it's possible to
-# have more parts
+# have more parts. The masks are computed once for the whole block, then each cut white
+# the other side of the line in both the pixels and the masks.
 def __try_to_smart_split_block(image, is_black_background, level=1):
     # type: (Image, bool, int) -> list[Image]
-    image = _simple_crop_image(image)
-    if DEBUG:
-        image.save('tmp/input_%s.jpg' % level)
-    image_height = __get_image_height(image)
-    image_width = __get_image_width(image)
-    print(" === [LEVEL=%s] Try to smart split block of size %s / %s  (mostly black=%s)" % (level, image_height, image_width, is_black_background))
-    
-    # Maybe the image is now too small: just give it back :)
-    if image_height <= 200:
-        return [image]
-    
-    split_pixel = WHITE_PIXEL if not is_black_background else (0, 0, 0)
-    print(" ==== Finding for pixel: %s" % str(split_pixel))
-    pixels = image.load()
-    for y in range(500, image_height - 200, 10):  # do not try to cut too early, it's useless
-        # First look if the left => higher right is possible for split
-        line_is_valid = False
-        found_angle = None
-        from_left = True
-        pixel = pixels[0, y]
-        if _is_background_pixel(pixel, is_black_background):
-            for angle_int in range(0, 200):
-                angle = float(angle_int) // 100
-                found_angle = angle
-                line_is_valid = True
-                for x in range(image_width):
-                    tested_pixel_y = y - ceil(x * angle)
-                    if tested_pixel_y <= 0:
-                        line_is_valid = False
-                        break
-                    tested_pixel = pixels[x, tested_pixel_y]
-                    if not _is_background_pixel(tested_pixel, is_black_background):
-                        line_is_valid = False
-                        break
-                # We did found a valid split line
-                if line_is_valid:
-                    break
-            if line_is_valid:
-                print("LEFT:: found a valid split line, angle=%s y=%s" % (found_angle, y))
-        
-        # Then is the line is not found look if the right => higher left is possible for split
-        if not line_is_valid and pixels[image_width - 1, y] == split_pixel:
-            from_left = False
-            for angle_int in range(0, 200):
-                angle = float(angle_int) // 100
-                found_angle = angle
-                line_is_valid = True
-                
-                for x in range(image_width - 1, -1, -1):
-                    tested_pixel_y = y - int(ceil((image_width - x) * angle))
-                    if tested_pixel_y <= 0:
-                        line_is_valid = False
-                        break
-                    
-                    tested_pixel = pixels[x, tested_pixel_y]
-                    if not _is_background_pixel(tested_pixel, is_black_background):
-                        line_is_valid = False
-                        break
-                # We did found a valid split line
-                if line_is_valid:
-                    # print "[RIGHT] Line %s is splitable with angle=%s" % (y, found_angle)
-                    break
-        
-        # Maybe nor left or right was able to split, skip this line
-        if not line_is_valid:
-            continue
+    pixels = numpy.array(image.convert('RGB'))  # our copy: the white fill is done in it
+    background = _get_background_mask(pixels, is_black_background)
+    not_white = (pixels != 255).any(axis=2)  # what _simple_crop_image keeps
+    is_split_pixel = (pixels == (0 if is_black_background else 255)).all(axis=2)
+    
+    res = []
+    (left, top, right, bottom) = (0, 0, pixels.shape[1], pixels.shape[0])
+    while True:
+        bbox = _get_mask_bbox(not_white[top:bottom, left:right])
+        if bbox is not None:
+            (left, top, right, bottom) = (left + bbox[0], top + bbox[1], left + bbox[2], top + bbox[3])
+        block = (slice(top, bottom), slice(left, right))
+        image_height = bottom - top
+        if DEBUG:
+            Image.fromarray(pixels[block]).save('tmp/input_%s.jpg' % level)
+        print(" === [LEVEL=%s] Try to smart split block of size %s / %s  (mostly black=%s)" % (level, image_height, right - left, is_black_background))
         
-        print("Yeah, we can cut from %s with angle %s and from left:%s" % (y, found_angle, from_left))
+        # Maybe the image is now too small: just give it back :)
+        if image_height <= 200:
+            res.append(Image.fromarray(pixels[block]))
+            return res
         
-        split_pixels = {}
-        if from_left:
-            for x in range(image_width):
-                split_pixels[x] = y - int(ceil(x * found_angle))
-        else:
-            for x in range(image_width - 1, -1, -1):
-                split_pixels[x] = y - int(ceil((image_width - x) * found_angle))
-        lower_y = min(split_pixels.values())
-        higher_y = max(split_pixels.values())
+        split_pixels = __find_smart_cut_line(background[block], is_split_pixel[block])
+        if split_pixels is None:
+            break
+        lower_y = int(split_pixels.min())
+        higher_y = int(split_pixels.max())
+        if DEBUG:
+            print("SPLIT RANGE", lower_y, higher_y)
         
         # We will have 2 images:
         # * higher part that will erase all UNDER the line
         # * lower part that will erase all TOP the line
-        higher_part_image = image.copy()
-        higher_part_pixels = higher_part_image.load()
-        rest_to_split_image = image.copy()
-        rest_to_split_pixels = rest_to_split_image.load()
-        
-        # For debug:
-        if DEBUG:
-            if from_left:
-                for x in range(image_width):
-                    tested_pixel_y = y - ceil(x * found_angle)
-                    # print " ====== LEFT [Y=%s Angle=%s] SPLIT LINE WAS Testing pixel %s / %s :: %s" % (y, found_angle, x, tested_pixel_y, str(pixels[x, tested_pixel_y]))
-                    pixels[x, tested_pixel_y] = (255, 0, 0)
-            else:
-                for x in range(image_width - 1, -1, -1):
-                    tested_pixel_y = y - int(ceil((image_width - x) * found_angle))
-                    # print " ====== RIGHT [Y=%s Angle=%s] SPLIT LINE WAS Testing pixel %s / %s :: %s" % (y, found_angle, x, tested_pixel_y, str(pixels[x, tested_pixel_y]))
-                    pixels[x, tested_pixel_y] = (255, 0, 0)
-        
+        split_rows = numpy.arange(lower_y, higher_y)[:, None]
+        higher_part_pixels = pixels[top:top + higher_y, left:right].copy()
+        higher_part_pixels[lower_y:higher_y][split_rows > split_pixels[None, :]] = WHITE_PIXEL
+        res.append(Image.fromarray(higher_part_pixels))
         if DEBUG:
-            image.save('tmp/with_line_%s.jpg' % level)
-            print("SPLIT RANGE", lower_y, higher_y)
+            res[-1].save('tmp/higher_part_%s.jpg' % level)
         
-        # HIGHER PART: clean all BELOW the line
-        for y in range(lower_y, higher_y):
-            for x in range(image_width):
-                line_y = split_pixels[x]
-                if y > higher_y or y > line_y:
-                    higher_part_pixels[x, y] = WHITE_PIXEL
-        
-        # We must crop it to remove all useless part
-        higher_part_image = higher_part_image.crop((0, 0, image_width, higher_y))
-        if DEBUG:
-            higher_part_image.save('tmp/higher_part_%s.jpg' % level)
-        
-        # LOWER PART: clean all OVER the line
-        for y in range(lower_y, higher_y):
-            for x in range(image_width):
-                line_y = split_pixels[x]
-                if y < lower_y or y < line_y:
-                    rest_to_split_pixels[x, y] = WHITE_PIXEL
-        
-        rest_to_split_image = rest_to_split_image.crop((0, lower_y, image_width, image_height))
-        if DEBUG:
-            rest_to_split_image.save('tmp/rest_%s.jpg' % level)
-        
-        res = [higher_part_image]
-        
-        rest_image_splitted = __try_to_smart_split_block(rest_to_split_image, is_black_background, level=level + 1)
-        res.extend(rest_image_splitted)
-        
-        return res
+        over_the_line = split_rows < split_pixels[None, :]
+        split_band = (slice(top + lower_y, top + higher_y), slice(left, right))
+        pixels[split_band][over_the_line] = WHITE_PIXEL
+        background[split_band][over_the_line] = not is_black_background
+        not_white[split_band][over_the_line] = False
+        is_split_pixel[split_band][over_the_line] = not is_black_background
+        top += lower_y
+        level += 1
     
     # We did fail to split it so give back the original image
     print("did fail to smart split the image, still %s high" % image_height)
-    # fuck
-    fail_back_images = __fail_back_to_cut_very_big_one(image)
-    return fail_back_images
+    res.extend(__fail_back_to_cut_very_big_one(pixels[block], background[block]))
+    return res
 
 
 def __parse_webtoon_block(image, start_of_box, width, end_of_box, split_final_images, is_black_background):
     # type: (Image, int, int, int, list[Image], bool) -> None
-    from .similarity import similarity
+    from .similarity import get_similarity
+    similarity = get_similarity()
     box_image = image.crop((0, start_of_box, width, end_of_box))
     
     potential_images = [box_image]
@@ -767,8 +888,9 @@ def __parse_webtoon_block(image, start_of_box, width, end_of_box, split_final_im
         # TODO: TEST: if all pixels are black: drop
         image_cropped = _auto_crop_image(p_image)
         print('  ** image cropped size: %s' % str(image_cropped.size))
+        analysis = PageAnalysis(image_cropped)
         try:
-            variance = _get_image_variance(image_cropped)
+            variance = analysis.get_variance()
         except ZeroDivisionError:  # seems that the image is too small, let the real test look for it
             print('   ** Image seems to have issue, skipping variance check')
             variance = 999  # do not delete it
@@ -804,36 +926,17 @@ def _split_webtoon(image):
     print(" TOON: analysing image %s/%s  (is black background=%s)" % (width, height, is_black_background))
     MIN_COLOR_HEIGHT = 30  # not less than 30px for a picture
     MAX_BOX_HEIGHT = 1400  # if more than 1400, if possible, close box
-    pixels = image.load()  # this is not a list, nor is it list()'able
-    
-    lines = []
-    for y in range(height):
-        is_white = True
-        for x in range(width):
-            cpixel = pixels[x, y]
-            # If classic white background
-            if not is_black_background:
-                if cpixel != WHITE_PIXEL:
-                    is_white = False
-                    break
-            else:  # black background, do not look at black
-                if y == LINE_DEBUG:
-                    print("PIXEL: %s => %s" % (x, str(cpixel)))
-                if not _is_quite_black(cpixel) and not cpixel == WHITE_PIXEL:
-                    is_white = False
-                    break
-                # else:
-                #    print "Line %s is white" % y
-        if y == LINE_DEBUG:
-            print("%s IS WHITE LINE: %s" % (y, is_white))
-        lines.append((y, is_white))
-    
-    print("Number of white lines: %s" % (len([c for c in lines if c[1]])))
+    
+    white_lines = _get_background_rows(image, is_black_background, tolerance=parameters.get_webtoon_background_tolerance())
+    if 0 <= LINE_DEBUG < height:
+        print("%s IS WHITE LINE: %s" % (LINE_DEBUG, white_lines[LINE_DEBUG]))
+    
+    print("Number of white lines: %s" % int(white_lines.sum()))
     
     start_of_box = None
     in_box = False
     last_black_line = None
-    for (y, is_white_line) in lines:
+    for (y, is_white_line) in enumerate(white_lines.tolist()):
         # First line: we are starting a box or not
         if y == 0:
             in_box = not is_white_line
@@ -891,9 +994,9 @@ def _split_webtoon(image):
 
 def guess_manga_or_webtoon_image(source):
     # type: (str) -> str
-    image = _load_image(source)
     try:
-        width, height = image.size
+        with Image.open(source) as image:  # only the header is read
+            width, height = image.size
     except IOError:
         raise RuntimeError('Cannot read image file %s' % source)
     
@@ -903,36 +1006,195 @@ def guess_manga_or_webtoon_image(source):
     return 'webtoon' if height > 4 * width else 'manga'
 
 
+# The file is read at once and closed: the decode is lazy, so the file handle would stay open
+# until the garbage collector closes it
 def _load_image(source):
-    # type: (str) -> Image
+    # type: (str|io.BytesIO) -> Image
     try:
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                source = io.BytesIO(f.read())
         return Image.open(source)
     except IOError:
         raise RuntimeError('Cannot read image file %s' % source)
 
 
+JPEG_DCT_SCALES = (8, 4, 2)  # the JPEG decoder can give directly 1/8, 1/4 or 1/2 of the image
+
+
+# The JPEG DC coefficients give a 1/8 image almost for free: if even it has no chroma, the page is grey.
+# The requested size is rounded down, so PIL does take the 1/8 scale.
+def _is_grey_jpeg(image):
+    # type: (Image) -> bool
+    if image.mode == 'L':
+        return True
+    if image.mode != 'RGB':
+        return False
+    with Image.open(io.BytesIO(image.fp.getvalue())) as probe:  # _load_image did give a BytesIO
+        probe.draft('RGB', (max(1, probe.size[0] // 8), max(1, probe.size[1] // 8)))
+        analysis = PageAnalysis(probe)
+    return max(analysis.red_green_difference_max, analysis.red_blue_difference_max) < COLOR_SATURATION_LIMIT
+
+
+# Smallest scale of the source that still gives at least the device size for all parts, with the margin
+# for the auto crop. Both orientations are looked at, as the crop can change the orientation.
+def _get_needed_scale(image_size, parts, device_size, margin):
+    # type: (tuple[int, int], list[tuple[bool, bool]], tuple[int, int], float) -> float
+    width, height = image_size
+    needed_scale = 0.0
+    for (split_right, split_left) in parts:
+        part_width = width // 2 if (split_right or split_left) else width
+        for (device_width, device_height) in (device_size, device_size[::-1]):
+            needed_scale = max(needed_scale, min(device_width / part_width, device_height / height))
+    return needed_scale * (1 + margin)
+
+
+# Fast decode path for JPEG sources: let the decoder give a DCT scaled image when the source is far
+# bigger than the device, and directly a greyscale one when the page is grey. Must be called before
+# the pixels are loaded.
+def _draft_image(image, parts, device_size):
+    # type: (Image, list[tuple[bool, bool]], tuple[int, int]) -> None
+    if image.format != 'JPEG' or not parameters.is_fast_decode():
+        return
+    before = time.time()
+    mode = 'L' if _is_grey_jpeg(image) else image.mode
+    needed_scale = _get_needed_scale(image.size, parts, device_size, parameters.get_decode_margin())
+    draft_size = None
+    for dct_scale in JPEG_DCT_SCALES:
+        if needed_scale <= 1 / dct_scale:
+            # PIL takes the scale as size // requested size: a rounded up request would give the next bigger
+            # scale for all the sizes that are not a multiple of it. The decoded size is still rounded up.
+            draft_size = (image.size[0] // dct_scale, image.size[1] // dct_scale)
+            break
+    source_size = image.size
+    image.draft(mode, draft_size)
+    print(f' * Fast decode: {source_size} {image.mode} => {image.size} {mode} (in {time.time() - before:.3f}s)')
+
+
+LOW_BITS_MAX_COLORS = 16  # PNG palettes of 2, 4 and 16 colors are written with 1, 2 and 4 bits by pixel
+
+
+# A page in a device palette uses at most 16 colors, but its palette is padded to 256 entries, so PIL writes
+# it as an 8 bits PNG. With the palette trimmed to the used colors, PIL writes a 1, 2 or 4 bits PNG: less
+# data for zlib, a smaller file, and exactly the same pixels (only the entries order can change).
+def _compact_palette_image(image):
+    # type: (Image) -> Image
+    if image.mode != 'P' or 'transparency' in image.info:
+        return image
+    pixels = numpy.asarray(image)
+    used_indexes = numpy.flatnonzero(numpy.bincount(pixels.ravel(), minlength=256))
+    if len(used_indexes) > LOW_BITS_MAX_COLORS:
+        return image
+    index_lut = numpy.zeros(256, dtype=numpy.uint8)
+    index_lut[used_indexes] = numpy.arange(len(used_indexes))
+    palette = image.getpalette()
+    compact_image = Image.fromarray(index_lut[pixels])
+    compact_image.putpalette([value for idx in used_indexes for value in palette[idx * 3:idx * 3 + 3]])  # L -> P
+    return compact_image
+
+
+# reportlab gives the pixels to the PDF as RGB for a P image, but as DeviceGray for an L one: a page in a grey
+# palette is the same pixels in L, with a third of the data
+def get_pdf_page_image(image):
+    # type: (Image) -> Image
+    if image.mode != 'P' or 'transparency' in image.info:
+        return image
+    palette = image.getpalette()
+    if palette[0::3] != palette[1::3] or palette[0::3] != palette[2::3]:
+        return image
+    return image.convert('L')
+
+
 def save_image(image, target):
     # type: (Image, str) -> None
     try:
-        image.save(target)
+        _compact_palette_image(image).save(target)
     except IOError:
         raise RuntimeError('Cannot write image file %s' % target)
 
 
+# Same bytes as save_image() into a .png file, but in a file object (an archive member, a buffer)
+def save_png(image, f):
+    # type: (Image, io.BufferedIOBase) -> None
+    _compact_palette_image(image).save(f, format='PNG')
+
+
+# Same bytes as save_image() into a .png file, but in memory
+def encode_image(image):
+    # type: (Image) -> bytes
+    try:
+        with io.BytesIO() as f:
+            save_png(image, f)
+            return f.getvalue()
+    except IOError:
+        raise RuntimeError('Cannot encode image %s' % image)
+
+
 # Look if the image is more width than height, if not, means it's should not be split (like the front page of a manga,
 # when all the inner pages are double)
 def is_splitable(source):
     # type: (str) -> bool
-    image = _load_image(source)
     try:
-        width, height = image.size
-        return width > height
+        with Image.open(source) as image:  # only the header is read
+            width, height = image.size
+            return width > height
     except IOError:
         raise RuntimeError('Cannot read image file %s' % source)
 
 
-def convert_image(source, split_right=False, split_left=False):
-    # type: (str,  bool, bool) -> list[Image]
+PASSTHROUGH_MODES = ('1', 'L', 'P')
+PASSTHROUGH_MAX_MARGIN = 4  # white columns/rows left on a side by a previous resize are not worth a conversion
+
+
+# A source that already meets the device spec can go in the book as is, without decode/convert/encode:
+#  * header: a PNG, grey (1, L, or P with a grey palette), in the device size and orientation
+#  * content, cheap as it is not bigger than the device: no white margin (of more than a few pixels) to crop
+def is_passthrough_page(data, device):
+    # type: (bytes, str) -> bool
+    width_dev, height_dev = EReaderData.get_size(device)
+    try:
+        with Image.open(io.BytesIO(data)) as image:  # only the header is read
+            width, height = image.size
+            if image.format != 'PNG' or image.mode not in PASSTHROUGH_MODES or 'transparency' in image.info:
+                return False
+            if width > width_dev or height > height_dev or (width > height) != (width_dev > height_dev):
+                return False
+            if image.mode == 'P':
+                palette = image.getpalette()
+                if palette[0::3] != palette[1::3] or palette[0::3] != palette[2::3]:
+                    return False
+            ink_bbox = ImageOps.invert(image.convert('L')).getbbox()
+            if ink_bbox is None:
+                return False
+            margins = (ink_bbox[0], ink_bbox[1], width - ink_bbox[2], height - ink_bbox[3])
+            return max(margins) <= PASSTHROUGH_MAX_MARGIN
+    except (IOError, ValueError):  # let the conversion say what is wrong with it
+        return False
+
+
+def _convert_manga_image(image, size, palette, crop_image=None):
+    # type: (Image, tuple[int, int], list, Image|None) -> Image
+    # Auto crop (remove useless white) the image, orient it and adapt to the EReader native resolution
+    image = _crop_orient_resize_image(image, size, crop_image)
+    
+    # Grey :
+    #  * MANGA: if the image is mostly grey, we can apply a grey palette
+    #  * COMICS/WEBTOONS: but if it was with colors, then the pillow got a better result (but FAR bigger, so not ok for manga)
+    # Adapt to EReader palette
+    if _is_image_grey(image):
+        image = _apply_grey_palette(image, palette)  # palette are ok for manga black and white, and very small
+    elif parameters.is_smallest_color():
+        image = _quantize_image(image, palette)  # the palette one if its PNG is smaller, with fewer grey levels
+    else:
+        image = _apply_basic_grey(image)  # pillow is better for colors, but is very FAT
+    return image
+
+
+# Convert several parts of the same source, each one is (split_right, split_left). The source is decoded
+# only once, so a double page gives its 2 halves from the same buffer.
+# Give back the converted images of each part.
+def convert_image_parts(source, parts):
+    # type: (str|io.BytesIO, list[tuple[bool, bool]]) -> list[list[Image]]
     
     device = parameters.get_device()
     try:
@@ -949,36 +1211,56 @@ def convert_image(source, split_right=False, split_left=False):
         converted_images = []  # we can have more than 1 results
         images = _split_webtoon(image)
         for image in images:
-            image = _format_image_to_rgb(image)
+            if image.mode != 'L':  # the split does not change the mode, a grey strip stays grey
+                image = _format_image_to_rgb(image)
             image = _resize_image(image, size)
             image = _apply_basic_grey(image)
             converted_images.append(image)
         
-        return converted_images
-    
-    image = _format_image_to_rgb(image)
-    
-    # Apply splits:
-    if split_right:  # flags & ImageFlags.SplitRight:
-        image = _split_right(image)
-    if split_left:
-        # if flags & ImageFlags.SplitRightLeft:
-        image = _split_left(image)
-    
-    # Auto crop (remove useless white) the image, but before manage size and co, clean the source so
-    image = _auto_crop_image(image)
-    # Always Orient based the size: if too large, go paysage
-    image = _orient_image(image, size)
-    # Adapt to the EReader native resolution
-    image = _resize_image(image, size)
-    
-    # Grey :
-    #  * MANGA: if the image is mostly grey, we can apply a grey palette
-    #  * COMICS/WEBTOONS: but if it was with colors, then the pillow got a better result (but FAR bigger, so not ok for manga)
-    # Adapt to EReader palette
-    if _is_image_grey(image):
-        image = _apply_grey_palette(image, palette)  # palette are ok for manga black and white, and very small
-    else:
-        image = _apply_basic_grey(image)  # pillow is better for colors, but is very FAT
+        return [converted_images for _ in parts]
+    
+    _draft_image(image, parts, size)
+    image, crop_image = _format_image_mode(image)
+    
+    converted_parts = []
+    for (split_right, split_left) in parts:
+        part_image = image
+        part_crop_image = crop_image
+        # Apply splits:
+        if split_right:  # flags & ImageFlags.SplitRight:
+            part_image = _split_right(part_image)
+            part_crop_image = _split_right(part_crop_image) if crop_image is not image else part_image
+        if split_left:
+            # if flags & ImageFlags.SplitRightLeft:
+            part_image = _split_left(part_image)
+            part_crop_image = _split_left(part_crop_image) if crop_image is not image else part_image
+        
+        converted_parts.append([_convert_manga_image(part_image, size, palette, part_crop_image)])  # only one image if not webtoon
     
-    return [image]  # only one image if not webtoon
+    return converted_parts
+
+
+def convert_image(source, split_right=False, split_left=False):
+    # type: (str|io.BytesIO,  bool, bool) -> list[Image]
+    return convert_image_parts(source, [(split_right, split_left)])[0]
+
+
+# To choose the resample preset of a device: time of the orient+resize of the (full) source pages with each
+# preset, and their similarity to the 'best' one.
+# Give preset => (total time, mean similarity, min similarity)
+def compare_resample_presets(sources, size):
+    # type: (list[str], tuple[int, int]) -> dict[RESAMPLE_PRESET, tuple[float, float, float]]
+    times = {preset: 0.0 for preset in RESAMPLE_PRESET}
+    similarities = {preset: [] for preset in RESAMPLE_PRESET}
+    for source in sources:
+        image, crop_image = _format_image_mode(_load_image(source))
+        box = _get_auto_crop_box(crop_image)  # the same for all presets
+        resized_images = {}
+        for preset in RESAMPLE_PRESET:
+            before = time.time()
+            resized_images[preset] = _orient_resize_box(image, box, size, preset)
+            times[preset] += time.time() - before
+        for preset in RESAMPLE_PRESET:
+            similarities[preset].append(get_ssim(resized_images[preset], resized_images[RESAMPLE_PRESET.BEST]))
+    return {preset: (times[preset], sum(similarities[preset]) / max(1, len(sources)), min(similarities[preset], default=1.0))
+            for preset in RESAMPLE_PRESET}
@@ -0,0 +1,175 @@
+# Copyright 2011-2019 Alex Yatskov
+# Copyright 2020+     Gabès Jean (naparuba@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# All the numbers the crop, grey and webtoon decisions need about an image, computed in one pass
+# over its pixels, instead of each decision walking the buffer again with its own PIL call.
+
+from enum import Enum
+
+import numpy
+from PIL import Image
+
+_SQUARES = (numpy.arange(256, dtype=numpy.uint32) ** 2).astype(numpy.uint16)  # 255² still fits
+
+COLOR_SATURATION_LIMIT = 10  # a diff in 10 (on 255) between channels is ok for "quite the same", so grey
+
+
+class PIXEL_CATEGORY(Enum):
+    WHITE = 1
+    BLACK = 2
+    GREY = 3
+    OTHER = 4
+
+
+# Chroma classifier of a N x 3 array of RGB pixels. WHITE and BLACK have a 0 saturation, so all pixels
+# over the saturation limit are OTHER (real colors).
+def count_pixel_categories(pixels):
+    # type: (numpy.ndarray) -> dict[PIXEL_CATEGORY, int]
+    red, green, blue = pixels[:, 0], pixels[:, 1], pixels[:, 2]
+    saturation = numpy.maximum(numpy.maximum(red, green) - numpy.minimum(red, green),
+                               numpy.maximum(red, blue) - numpy.minimum(red, blue))
+    nb_white = int(numpy.count_nonzero((red & green & blue) == 255))
+    nb_black = int(numpy.count_nonzero((red | green | blue) == 0))
+    nb_other = int(numpy.count_nonzero(saturation >= COLOR_SATURATION_LIMIT))
+    return {PIXEL_CATEGORY.WHITE: nb_white,
+            PIXEL_CATEGORY.BLACK: nb_black,
+            PIXEL_CATEGORY.GREY:  len(pixels) - nb_white - nb_black - nb_other,
+            PIXEL_CATEGORY.OTHER: nb_other,
+            }
+
+
+class PageAnalysis(object):
+    def __init__(self, image):
+        # type: (Image) -> None
+        self.mode = image.mode
+        self.width, self.height = image.size
+        pixels = numpy.asarray(image if image.mode in ('L', 'RGB') else image.convert('RGB'))
+        if pixels.ndim == 2:
+            pixels = pixels[:, :, None]
+        
+        # Ink = all but pure white pixels, what ImageChops.invert(image).getbbox() is looking for
+        all_bands = pixels[:, :, 0]
+        for band_idx in range(1, pixels.shape[2]):
+            all_bands = all_bands & pixels[:, :, band_idx]
+        self._ink = all_bands != 255
+        self.row_inks = self._ink.sum(axis=1)  # number of ink pixels by row
+        self.column_inks = self._ink.sum(axis=0)
+        self.bbox = self._get_profiles_bbox(self.row_inks, self.column_inks)
+        any_band = pixels[:, :, 0]
+        for band_idx in range(1, pixels.shape[2]):
+            any_band = any_band | pixels[:, :, band_idx]
+        self.nb_black_pixels = int(numpy.count_nonzero(any_band == 0))
+        
+        # Chroma: the saturation is the biggest of |r-g| and |r-b|, 0 for a pure grey pixel
+        if pixels.shape[2] >= 3:
+            red, green, blue = pixels[:, :, 0], pixels[:, :, 1], pixels[:, :, 2]
+            red_green = numpy.maximum(red, green) - numpy.minimum(red, green)
+            red_blue = numpy.maximum(red, blue) - numpy.minimum(red, blue)
+            self.red_green_difference_max = int(red_green.max(initial=0))
+            self.red_blue_difference_max = int(red_blue.max(initial=0))
+            self.saturation_histogram = Image.fromarray(numpy.maximum(red_green, red_blue)).histogram()
+        else:
+            self.red_green_difference_max = 0
+            self.red_blue_difference_max = 0
+            self.saturation_histogram = [self.width * self.height] + [0] * 255
+        
+        # First band (like ImageStat var[0]) sums by row, as prefix sums: any band of rows is 2 lookups
+        first_band = pixels[:, :, 0]
+        self._first_band = first_band
+        self._row_sums = numpy.concatenate(([0], numpy.cumsum(first_band.sum(axis=1, dtype=numpy.int64))))
+        self._row_square_sums = numpy.concatenate(([0], numpy.cumsum(_SQUARES[first_band].sum(axis=1, dtype=numpy.int64))))
+        # Same by column, for the band of rows of the last get_box_variance call
+        self._columns_rows = None  # type: tuple[int, int]|None
+        self._column_sums = None  # type: numpy.ndarray|None
+        self._column_square_sums = None  # type: numpy.ndarray|None
+    
+    
+    @staticmethod
+    def _get_profiles_bbox(row_inks, column_inks):
+        # type: (numpy.ndarray, numpy.ndarray) -> tuple[int, int, int, int]|None
+        rows = numpy.flatnonzero(row_inks)
+        if len(rows) == 0:
+            return None
+        columns = numpy.flatnonzero(column_inks)
+        return int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+    
+    
+    # bbox of the ink of the rows [top, bottom) only, in the image coordinates
+    def get_ink_bbox(self, top=0, bottom=None):
+        # type: (int, int|None) -> tuple[int, int, int, int]|None
+        if top == 0 and bottom in (None, self.height):
+            return self.bbox
+        ink = self._ink[top:bottom]
+        bbox = self._get_profiles_bbox(ink.sum(axis=1), ink.any(axis=0))
+        if bbox is None:
+            return None
+        return bbox[0], bbox[1] + top, bbox[2], bbox[3] + top
+    
+    
+    @staticmethod
+    def _compute_variance(pixels_sum, square_sum, nb_pixels):
+        # type: (int, int, int) -> float
+        # ImageStat formula, with floats: an empty crop raises ZeroDivisionError like it
+        pixels_sum = float(pixels_sum)
+        return (float(square_sum) - (pixels_sum ** 2.0) / nb_pixels) / nb_pixels
+    
+    
+    # Same value as ImageStat.Stat(image.crop((0, top, width, bottom))).var[0]: rows out of the image
+    # are black, like in a PIL crop.
+    def get_rows_variance(self, top, bottom):
+        # type: (int, int) -> float
+        nb_pixels = (bottom - top) * self.width
+        top = min(max(top, 0), self.height)
+        bottom = min(max(bottom, 0), self.height)
+        return self._compute_variance(self._row_sums[bottom] - self._row_sums[top],
+                                  self._row_square_sums[bottom] - self._row_square_sums[top],
+                                  nb_pixels)
+    
+    
+    # Same value as ImageStat.Stat(image.crop((left, top, right, bottom))).var[0], pixels out of the image
+    # are black. The columns sums of the rows [top, bottom) are done at the first call for these rows, then
+    # any range of columns in them is 2 lookups.
+    def get_box_variance(self, left, top, right, bottom):
+        # type: (int, int, int, int) -> float
+        nb_pixels = (right - left) * (bottom - top)
+        if self._columns_rows != (top, bottom):
+            rows = self._first_band[min(max(top, 0), self.height):min(max(bottom, 0), self.height)]
+            self._column_sums = numpy.concatenate(([0], numpy.cumsum(rows.sum(axis=0, dtype=numpy.int64))))
+            self._column_square_sums = numpy.concatenate(([0], numpy.cumsum(_SQUARES[rows].sum(axis=0, dtype=numpy.int64))))
+            self._columns_rows = (top, bottom)
+        left = min(max(left, 0), self.width)
+        right = min(max(right, 0), self.width)
+        return self._compute_variance(self._column_sums[right] - self._column_sums[left],
+                                  self._column_square_sums[right] - self._column_square_sums[left],
+                                  nb_pixels)
+    
+    
+    def get_variance(self):
+        # type: () -> float
+        return self.get_rows_variance(0, self.height)
+    
+    
+    # Same counts as count_pixel_categories() on all the pixels, read from the saturation histogram
+    def get_category_counts(self):
+        # type: () -> dict[PIXEL_CATEGORY, int]
+        nb_pixels = self.width * self.height
+        nb_white = nb_pixels - int(self.row_inks.sum())
+        nb_other = sum(self.saturation_histogram[COLOR_SATURATION_LIMIT:])
+        return {PIXEL_CATEGORY.WHITE: nb_white,
+                PIXEL_CATEGORY.BLACK: self.nb_black_pixels,
+                PIXEL_CATEGORY.GREY:  nb_pixels - nb_white - self.nb_black_pixels - nb_other,
+                PIXEL_CATEGORY.OTHER: nb_other,
+                }
@@ -0,0 +1,192 @@
+# Copyright 2011-2019 Alex Yatskov
+# Copyright 2020+     Gabès Jean (naparuba@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Persistent cache of the converted pages, so re-running a book only converts the new/changed sources.
+# An entry is keyed by the hash of the source file content + all the conversion options, and holds the
+# encoded output images of one part (a split half, a full page, or all the images of a webtoon strip).
+
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import traceback
+
+# Bump it each time a change in the conversion code changes the output pages, so old entries are not used
+PIPELINE_VERSION = 9
+
+_MAGIC = b'HSKC'
+_HEADER = struct.Struct('<4sI')  # magic, number of images
+_IMAGE_SIZE = struct.Struct('<Q')
+
+
+class PageCache(object):
+    def __init__(self, directory, max_size):
+        # type: (str, int) -> None
+        self._directory = directory
+        self._max_size = max_size  # in bytes, least recently used entries are removed over it
+        self._lock = threading.Lock()
+        self._entries = {}  # key => [size, last used time]
+        self._total_size = 0
+        self._nb_hits = 0
+        self._nb_misses = 0
+        self._nb_evictions = 0
+        self._load_index()
+    
+    
+    @staticmethod
+    def hash_source(data):
+        # type: (bytes) -> str
+        return hashlib.sha256(data).hexdigest()
+    
+    
+    @staticmethod
+    def get_key(source_hash, split_side, conversion_options):
+        # type: (str, str, dict) -> str
+        key_data = json.dumps([PIPELINE_VERSION, source_hash, split_side, conversion_options], sort_keys=True)
+        return hashlib.sha256(key_data.encode('utf8')).hexdigest()
+    
+    
+    def _get_path(self, key):
+        # type: (str) -> str
+        return os.path.join(self._directory, key[:2], key + '.bin')
+    
+    
+    # The file modification time is used as last used time: it is updated at each hit
+    def _load_index(self):
+        t0 = time.time()
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        for sub_directory in os.scandir(self._directory):
+            if not sub_directory.is_dir():
+                continue
+            for entry in os.scandir(sub_directory.path):
+                if not entry.name.endswith('.bin'):
+                    continue
+                stat = entry.stat()
+                self._entries[entry.name[:-len('.bin')]] = [stat.st_size, stat.st_mtime]
+                self._total_size += stat.st_size
+        print(f'[CACHE] {self._directory}: {len(self._entries)} pages ({self._total_size // (1024 * 1024)}MB) loaded in {time.time() - t0:.3f}s')
+    
+    
+    def get(self, key):
+        # type: (str) -> list[bytes]|None
+        path = self._get_path(key)
+        with self._lock:
+            if key not in self._entries:
+                self._nb_misses += 1
+                return None
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            images = self._unpack(data)
+            os.utime(path)
+        except (OSError, ValueError):  # removed by another process, or truncated
+            print(f'[CACHE] cannot read {path}: {traceback.format_exc()}')
+            with self._lock:
+                self._forget(key)
+                self._nb_misses += 1
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries[key][1] = time.time()
+            self._nb_hits += 1
+        return images
+    
+    
+    def put(self, key, images):
+        # type: (str, list[bytes]) -> None
+        data = self._pack(images)
+        if len(data) > self._max_size:
+            return
+        path = self._get_path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)  # atomic: other processes never see a partial entry
+        except OSError:
+            print(f'[CACHE] cannot write {path}: {traceback.format_exc()}')
+            return
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = [len(data), time.time()]
+            self._total_size += len(data)
+            self._evict()
+    
+    
+    def _forget(self, key):
+        # type: (str) -> None
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_size -= entry[0]
+    
+    
+    # Remove the least recently used entries until we are under the max size
+    def _evict(self):
+        if self._total_size <= self._max_size:
+            return
+        for (key, (size, _)) in sorted(self._entries.items(), key=lambda item: item[1][1]):
+            if self._total_size <= self._max_size:
+                break
+            try:
+                os.unlink(self._get_path(key))
+            except FileNotFoundError:  # another process did already remove it
+                pass
+            self._forget(key)
+            self._nb_evictions += 1
+    
+    
+    @staticmethod
+    def _pack(images):
+        # type: (list[bytes]) -> bytes
+        parts = [_HEADER.pack(_MAGIC, len(images))]
+        parts.extend(_IMAGE_SIZE.pack(len(image)) for image in images)
+        parts.extend(images)
+        return b''.join(parts)
+    
+    
+    @staticmethod
+    def _unpack(data):
+        # type: (bytes) -> list[bytes]
+        magic, nb_images = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC:
+            raise ValueError('Not a page cache entry')
+        offset = _HEADER.size
+        sizes = []
+        for _ in range(nb_images):
+            sizes.append(_IMAGE_SIZE.unpack_from(data, offset)[0])
+            offset += _IMAGE_SIZE.size
+        images = []
+        for size in sizes:
+            images.append(data[offset:offset + size])
+            offset += size
+        if offset != len(data):
+            raise ValueError('Truncated page cache entry')
+        return images
+    
+    
+    def get_stats(self):
+        # type: () -> dict[str, int]
+        with self._lock:
+            return {'hits':      self._nb_hits,
+                    'misses':    self._nb_misses,
+                    'evictions': self._nb_evictions,
+                    'entries':   len(self._entries),
+                    'size':      self._total_size,
+                    }
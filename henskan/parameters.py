@@ -32,6 +32,23 @@ class Parameters(object):
     _device_index: int
     
     _is_webtoon: bool
+    _webtoon_background_tolerance: int
+    _grey_sample_size: int
+    _is_fast_decode: bool
+    _decode_margin: float
+    _grey_dither: str
+    _resample_preset: str
+    _is_passthrough: bool
+    _is_smallest_color: bool
+    _unwanted_digest: str
+    _is_clean_deleted: bool
+    _deleted_dump: str
+    _duplicate_mode: str
+    
+    _nb_workers: int
+    
+    _cache_directory: str
+    _cache_max_size: int
     
     _split_right_then_left = False
     _split_left_then_right = False
@@ -54,11 +71,31 @@ class Parameters(object):
         self._split_left_then_right = False
         self._split_left_then_right = False
         self._is_webtoon = False
+        self._webtoon_background_tolerance = 0  # 0 = only pure white/black rows are cut points
+        self._grey_sample_size = 0  # 0 = the grey detection looks at all pixels
+        # JPEG: decode directly at a reduced size, and in greyscale for grey pages. Off by default: the auto crop
+        # steps and thresholds are in pixels, so on the reduced image its box (and the page size) can change.
+        self._is_fast_decode = False
+        self._decode_margin = 0.25  # the reduced decode keeps at least 25% more pixels than the device size
+        # how grey pages go to the device palette: floyd-steinberg (PIL quantize), or the faster LUT ones ordered or none
+        self._grey_dither = 'floyd-steinberg'
+        self._resample_preset = 'best'  # resize quality/speed: fast, balanced or best
+        self._is_passthrough = True  # sources that already meet the device spec go in the book as they are
+        self._is_smallest_color = False  # color pages: the smaller PNG of the device palette and plain grey versions
+        self._unwanted_digest = ''  # webtoon: digest of the unwanted images hashes, set by the converter
+        self._is_clean_deleted = True  # webtoon: remove the deleted blocks images of the previous runs
+        self._deleted_dump = 'images'  # webtoon: what is saved about the deleted blocks: images, metadata or none
+        self._duplicate_mode = 'keep'  # duplicate pages removed before the conversion: keep, exact or perceptual
+        
+        self._nb_workers = os.cpu_count() or 1  # 1 = convert the pages in the current process
         
         self._default_document_directory = str(Path.home())  # ~ on Linux
         if os.name == 'nt':
             self._default_document_directory = os.path.join(self._default_document_directory, 'Documents')
         self._output_directory = self._default_document_directory  # value used only at first launch, or if saved directory is missing
+        
+        self._cache_directory = os.path.join(self._default_document_directory, 'henskan_cache')
+        self._cache_max_size = 0  # 0 = no cache, the command line one is on by default (DEFAULT_CACHE_SIZE_MB)
     
     
     def __get_previous_parameter_path(self):
@@ -84,6 +121,10 @@ class Parameters(object):
                         self._device = device
                         self._device_index = device_index
                         print(f'Loaded previous device: {device} {device_index}')
+                    nb_workers = data.get('nb_workers', None)
+                    if isinstance(nb_workers, int) and nb_workers >= 1:
+                        self._nb_workers = nb_workers
+                        print(f'Loaded previous number of workers: {nb_workers}')
         except Exception as exp:
             print(f'Error in loading previous parameters: {exp}')
     
@@ -97,6 +138,7 @@ class Parameters(object):
                     'output_directory': self._output_directory,
                     'device':           self._device,
                     'device_index':     self._device_index,
+                    'nb_workers':       self._nb_workers,
                 }
                 json.dump(data, f)
                 print(f'Saved parameters to {previous_parameter_path}')
@@ -147,6 +189,174 @@ class Parameters(object):
         self._device_index = index
     
     
+    # All that changes the converted pages: it is given to the conversion processes, and is a part
+    # of the page cache key
+    def get_conversion_options(self):
+        # type: () -> dict
+        return {'device':                       self._device,
+                'is_webtoon':                   self._is_webtoon,
+                'webtoon_background_tolerance': self._webtoon_background_tolerance,
+                'grey_sample_size':             self._grey_sample_size,
+                'is_fast_decode':               self._is_fast_decode,
+                'decode_margin':                self._decode_margin,
+                'grey_dither':                  self._grey_dither,
+                'resample_preset':              self._resample_preset,
+                'is_passthrough':               self._is_passthrough,
+                'is_smallest_color':            self._is_smallest_color,
+                'unwanted_digest':              self._unwanted_digest,
+                }
+    
+    
+    def set_conversion_options(self, options):
+        # type: (dict) -> None
+        self._device = options['device']
+        self._is_webtoon = options['is_webtoon']
+        self._webtoon_background_tolerance = options['webtoon_background_tolerance']
+        self._grey_sample_size = options['grey_sample_size']
+        self._is_fast_decode = options['is_fast_decode']
+        self._decode_margin = options['decode_margin']
+        self._grey_dither = options['grey_dither']
+        self._resample_preset = options['resample_preset']
+        self._is_passthrough = options['is_passthrough']
+        self._is_smallest_color = options['is_smallest_color']
+        self._unwanted_digest = options['unwanted_digest']
+    
+    
+    def get_grey_sample_size(self):
+        return self._grey_sample_size
+    
+    
+    def set_grey_sample_size(self, sample_size):
+        # type: (int) -> None
+        self._grey_sample_size = max(0, sample_size)
+    
+    
+    def is_fast_decode(self):
+        return self._is_fast_decode
+    
+    
+    def set_fast_decode(self, is_fast_decode):
+        # type: (bool) -> None
+        self._is_fast_decode = is_fast_decode
+    
+    
+    def get_decode_margin(self):
+        return self._decode_margin
+    
+    
+    def set_decode_margin(self, margin):
+        # type: (float) -> None
+        self._decode_margin = max(0.0, margin)
+    
+    
+    def get_grey_dither(self):
+        return self._grey_dither
+    
+    
+    def set_grey_dither(self, grey_dither):
+        # type: (str) -> None
+        self._grey_dither = grey_dither
+    
+    
+    def get_resample_preset(self):
+        return self._resample_preset
+    
+    
+    def set_resample_preset(self, resample_preset):
+        # type: (str) -> None
+        self._resample_preset = resample_preset
+    
+    
+    def is_passthrough(self):
+        return self._is_passthrough
+    
+    
+    def set_passthrough(self, is_passthrough):
+        # type: (bool) -> None
+        self._is_passthrough = is_passthrough
+    
+    
+    def is_smallest_color(self):
+        return self._is_smallest_color
+    
+    
+    def set_smallest_color(self, is_smallest_color):
+        # type: (bool) -> None
+        self._is_smallest_color = is_smallest_color
+    
+    
+    def is_clean_deleted(self):
+        return self._is_clean_deleted
+    
+    
+    def set_clean_deleted(self, is_clean_deleted):
+        # type: (bool) -> None
+        self._is_clean_deleted = is_clean_deleted
+    
+    
+    def get_deleted_dump(self):
+        return self._deleted_dump
+    
+    
+    def set_deleted_dump(self, deleted_dump):
+        # type: (str) -> None
+        self._deleted_dump = deleted_dump
+    
+    
+    def get_duplicate_mode(self):
+        return self._duplicate_mode
+    
+    
+    def set_duplicate_mode(self, duplicate_mode):
+        # type: (str) -> None
+        self._duplicate_mode = duplicate_mode
+    
+    
+    def get_unwanted_digest(self):
+        return self._unwanted_digest
+    
+    
+    def set_unwanted_digest(self, unwanted_digest):
+        # type: (str) -> None
+        self._unwanted_digest = unwanted_digest
+    
+    
+    def get_webtoon_background_tolerance(self):
+        return self._webtoon_background_tolerance
+    
+    
+    def set_webtoon_background_tolerance(self, tolerance):
+        # type: (int) -> None
+        self._webtoon_background_tolerance = min(255, max(0, tolerance))
+    
+    
+    def get_cache_directory(self):
+        return self._cache_directory
+    
+    
+    def set_cache_directory(self, cache_directory):
+        # type: (str) -> None
+        self._cache_directory = cache_directory
+    
+    
+    def get_cache_max_size(self):
+        return self._cache_max_size
+    
+    
+    def set_cache_max_size(self, cache_max_size):
+        # type: (int) -> None
+        self._cache_max_size = max(0, cache_max_size)
+    
+    
+    def get_nb_workers(self):
+        return self._nb_workers
+    
+    
+    def set_nb_workers(self, nb_workers):
+        # type: (int) -> None
+        self._nb_workers = max(1, nb_workers)
+    
+    
     def is_split_left_then_right(self):
         return self._split_left_then_right
     
@@ -172,6 +382,12 @@ class Parameters(object):
     
     def get_images(self):
         return self._images
+    
+    
+    def remove_images(self, image_paths):
+        # type: (list[str]) -> None
+        removed = set(image_paths)
+        self._images = [image_path for image_path in self._images if image_path not in removed]
 
     # Sort images by natural key (so that 2.jpg comes before 10.jpg), after remove duplicates
     def sort_images(self):
@@ -0,0 +1,193 @@
+# Copyright 2011-2019 Alex Yatskov
+# Copyright 2020+     Gabès Jean (naparuba@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Streaming pipeline: items go through stages linked by bounded queues, each stage with its own
+# workers (threads for I/O, processes for CPU), and are given back in the input order.
+# NOTE: this module must NOT import PyQt6
+
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+_END = object()  # end of stream marker, one per worker of the next stage
+
+_POLL_INTERVAL = 0.1  # seconds: how often blocked workers look if the pipeline was stopped
+
+
+class Stage(object):
+    def __init__(self, name, func, nb_workers=1, use_processes=False, should_run=None):
+        # type: (str, callable, int, bool, callable) -> None
+        self.name = name
+        self.func = func  # must be a module level function when use_processes=True
+        self.nb_workers = max(1, nb_workers)
+        self.use_processes = use_processes
+        self.should_run = should_run  # if it returns False for an item, the item goes to the next stage as is
+
+
+class _StageError(object):
+    def __init__(self, stage_name, error, trace):
+        self.stage_name = stage_name
+        self.error = error
+        self.trace = trace
+
+
+class Pipeline(object):
+    def __init__(self, stages, queue_size=4, process_initializer=None, process_initargs=()):
+        # type: (list[Stage], int, callable, tuple) -> None
+        self._stages = stages
+        self._queue_size = max(1, queue_size)
+        self._process_initializer = process_initializer
+        self._process_initargs = process_initargs
+        # Max items between the input and the ordered output: a slow item cannot let the others pile up in memory
+        self._window = self._queue_size * (len(stages) + 1) + sum(stage.nb_workers for stage in stages)
+        
+        self._stop = threading.Event()
+        self._in_flight = threading.BoundedSemaphore(self._window)
+        self._queues = []
+        self._threads = []
+        self._executors = []
+        self._stats_lock = threading.Lock()
+        self._busy_time = {}  # stage name => sum of the time spent in its func
+    
+    
+    # The stage with the biggest busy time / nb_workers is the one that limits the throughput
+    def get_stage_times(self):
+        # type: () -> dict[str, float]
+        with self._stats_lock:
+            return dict(self._busy_time)
+    
+    
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=_POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+    
+    
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return _END
+    
+    
+    def _feed(self, items):
+        first_queue = self._queues[0]
+        try:
+            for (seq, item) in enumerate(items):
+                while not self._in_flight.acquire(timeout=_POLL_INTERVAL):
+                    if self._stop.is_set():
+                        return
+                self._put(first_queue, (seq, item))
+        except Exception as exp:  # the items generator itself did fail
+            self._put(self._queues[-1], (-1, _StageError('input', exp, traceback.format_exc())))
+        finally:
+            for _ in range(self._stages[0].nb_workers):
+                self._put(first_queue, _END)
+    
+    
+    def _work(self, stage_idx, executor, alive):
+        stage = self._stages[stage_idx]
+        in_queue = self._queues[stage_idx]
+        out_queue = self._queues[stage_idx + 1]
+        while True:
+            entry = self._get(in_queue)
+            if entry is _END:
+                break
+            (seq, item) = entry
+            if isinstance(item, _StageError) or (stage.should_run is not None and not stage.should_run(item)):  # just forward it
+                self._put(out_queue, (seq, item))
+                continue
+            t0 = time.time()
+            try:
+                if executor is not None:
+                    result = executor.submit(stage.func, item).result()
+                else:
+                    result = stage.func(item)
+            except Exception as exp:
+                result = _StageError(stage.name, exp, traceback.format_exc())
+            with self._stats_lock:
+                self._busy_time[stage.name] = self._busy_time.get(stage.name, 0.0) + time.time() - t0
+            self._put(out_queue, (seq, result))
+        
+        # The last worker of the stage to finish close the stream for the next stage
+        with alive['lock']:
+            alive['count'] -= 1
+            is_last = alive['count'] == 0
+        if is_last:
+            next_nb_workers = self._stages[stage_idx + 1].nb_workers if stage_idx + 1 < len(self._stages) else 1
+            for _ in range(next_nb_workers):
+                self._put(out_queue, _END)
+    
+    
+    def _start(self, items):
+        self._queues = [queue.Queue(maxsize=self._queue_size) for _ in range(len(self._stages) + 1)]
+        for (stage_idx, stage) in enumerate(self._stages):
+            executor = None
+            if stage.use_processes:
+                # spawn: do not fork a process that have Qt threads running
+                executor = ProcessPoolExecutor(max_workers=stage.nb_workers,
+                                               mp_context=multiprocessing.get_context('spawn'),
+                                               initializer=self._process_initializer,
+                                               initargs=self._process_initargs)
+                self._executors.append(executor)
+            alive = {'lock': threading.Lock(), 'count': stage.nb_workers}
+            for worker_idx in range(stage.nb_workers):
+                thread = threading.Thread(target=self._work, args=(stage_idx, executor, alive),
+                                          name=f'pipeline-{stage.name}-{worker_idx}', daemon=True)
+                self._threads.append(thread)
+        feeder = threading.Thread(target=self._feed, args=(items,), name='pipeline-feeder', daemon=True)
+        self._threads.append(feeder)
+        for thread in self._threads:
+            thread.start()
+    
+    
+    def _shutdown(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        for executor in self._executors:
+            executor.shutdown(wait=True, cancel_futures=True)
+    
+    
+    # Give back the results of the last stage, in the same order than items
+    def run(self, items):
+        self._start(items)
+        last_queue = self._queues[-1]
+        pending = {}
+        next_seq = 0
+        try:
+            while True:
+                entry = self._get(last_queue)
+                if entry is _END:
+                    break
+                (seq, result) = entry
+                if isinstance(result, _StageError):
+                    raise RuntimeError(f'Pipeline stage {result.stage_name} failed: {result.trace}') from result.error
+                pending[seq] = result
+                while next_seq in pending:
+                    yield pending.pop(next_seq)
+                    next_seq += 1
+                    self._in_flight.release()
+        finally:
+            self._shutdown()
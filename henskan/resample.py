@@ -0,0 +1,77 @@
+# Copyright 2011-2019 Alex Yatskov
+# Copyright 2020+     Gabès Jean (naparuba@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Quality/speed presets of the resize to the device size, and the similarity score used to compare them.
+# NOTE: this module must NOT import PyQt6: it is imported by the pool worker processes
+
+from enum import Enum
+
+import numpy
+from PIL import Image
+
+
+class RESAMPLE_PRESET(Enum):
+    FAST = 'fast'
+    BALANCED = 'balanced'
+    BEST = 'best'
+
+
+# preset => (filter, reducing_gap). With a reducing_gap, PIL first box reduces the source by an integer factor
+# while it stays at least reducing_gap times the target size, and the filter only does the last step.
+RESAMPLE_SETTINGS = {
+    RESAMPLE_PRESET.FAST:     (Image.Resampling.BILINEAR, 1.5),
+    RESAMPLE_PRESET.BALANCED: (Image.Resampling.BICUBIC, 2.0),
+    RESAMPLE_PRESET.BEST:     (Image.Resampling.LANCZOS, None),  # the filter on all the source pixels
+}
+
+
+def resample(image, size, preset, box=None):
+    # type: (Image, tuple[int, int], RESAMPLE_PRESET, tuple[int, int, int, int]|None) -> Image
+    resample_filter, reducing_gap = RESAMPLE_SETTINGS[preset]
+    return image.resize(size, resample_filter, box=box, reducing_gap=reducing_gap)
+
+
+SSIM_WINDOW = 8
+_SSIM_C1 = (0.01 * 255) ** 2
+_SSIM_C2 = (0.03 * 255) ** 2
+
+
+def _get_window_sums(values):
+    # type: (numpy.ndarray) -> numpy.ndarray
+    # Sums over all the SSIM_WINDOW x SSIM_WINDOW windows, from 2D prefix sums
+    sums = numpy.zeros((values.shape[0] + 1, values.shape[1] + 1))
+    sums[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+    return sums[SSIM_WINDOW:, SSIM_WINDOW:] - sums[:-SSIM_WINDOW, SSIM_WINDOW:] - sums[SSIM_WINDOW:, :-SSIM_WINDOW] + sums[:-SSIM_WINDOW, :-SSIM_WINDOW]
+
+
+# Mean SSIM of the grey levels, over all the 8x8 windows: 1.0 for the same image
+def get_ssim(image, reference):
+    # type: (Image, Image) -> float
+    if image.size != reference.size:
+        raise ValueError('Cannot compare images of different sizes %s and %s' % (image.size, reference.size))
+    x = numpy.asarray(image.convert('L'), dtype=numpy.float64)
+    y = numpy.asarray(reference.convert('L'), dtype=numpy.float64)
+    if min(x.shape) < SSIM_WINDOW:
+        return 1.0 if numpy.array_equal(x, y) else 0.0
+    nb_pixels = SSIM_WINDOW * SSIM_WINDOW
+    mean_x = _get_window_sums(x) / nb_pixels
+    mean_y = _get_window_sums(y) / nb_pixels
+    var_x = _get_window_sums(x * x) / nb_pixels - mean_x ** 2
+    var_y = _get_window_sums(y * y) / nb_pixels - mean_y ** 2
+    covariance = _get_window_sums(x * y) / nb_pixels - mean_x * mean_y
+    ssim = ((2 * mean_x * mean_y + _SSIM_C1) * (2 * covariance + _SSIM_C2)) / \
+           ((mean_x ** 2 + mean_y ** 2 + _SSIM_C1) * (var_x + var_y + _SSIM_C2))
+    return float(ssim.mean())
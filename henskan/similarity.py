@@ -14,72 +14,466 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import io
+import json
+import multiprocessing
+import queue
 import time
 import os
+import struct
+import threading
+from enum import Enum
+
+import numpy
 
 try:
-    from imagehash import imagehash
+    import imagehash
 except ImportError:
     imagehash = None
     print("Missing imagehash lib")
 
 from .image import Image
+from .parameters import parameters
 
 UNWANTED = r'C:\Users\j.gabes\Desktop\export\unwanted'
 DELETED = r'C:\Users\j.gabes\Desktop\export\deleted'
 
-# Mine are for debug, on other pc, use documents ones
+# Mine are for debug, on other pc, use documents ones. They are created at the Similarity init, not at import.
 if not os.path.exists(UNWANTED):
     UNWANTED = os.path.expanduser('~/Documents/henskan_unwanted')
-    if not os.path.exists(UNWANTED):
-        os.mkdir(UNWANTED)
 if not os.path.exists(DELETED):
     DELETED = os.path.expanduser('~/Documents/henskan_deleted')
-    if not os.path.exists(DELETED):
-        os.mkdir(DELETED)
+
+
+class DELETED_DUMP(Enum):
+    IMAGES = 'images'  # a JPEG of each dropped block, and its metadata line
+    METADATA = 'metadata'  # only the line in DELETED_METADATA_FILE
+    NONE = 'none'
+
+
+DELETED_METADATA_FILE = 'deleted.jsonl'
+# The dumps are written by a thread of each process, so a dropped block does not wait for its JPEG. Over the
+# queue size the dump is dropped, and over the caps (by conversion run, for all the processes) nothing more
+# is written.
+DELETED_QUEUE_SIZE = 16
+DELETED_MAX_ENTRIES = 500
+DELETED_MAX_BYTES = 100 * 1024 * 1024
 
 THRESHOLD = 6
 
 HASH_SIZE = 10
 
+MULTI_INDEX_MIN_SIZE = 2048  # under it, a linear scan of all hashes is quicker than the multi-index lookups
+
+_POPCOUNTS = numpy.array([bin(value).count('1') for value in range(256)], dtype=numpy.uint8)
+
+
+# The bits of an average_hash packed in bytes: 100 bits => 13 bytes
+def pack_hash(image_hash):
+    # type: (imagehash.ImageHash) -> numpy.ndarray
+    return numpy.packbits(image_hash.hash.ravel())
+
+
+# Hamming distances of one packed hash to all the rows of packed hashes, same as ImageHash - ImageHash
+def get_distances(packed_hashes, packed_hash):
+    # type: (numpy.ndarray, numpy.ndarray) -> numpy.ndarray
+    return _POPCOUNTS[packed_hashes ^ packed_hash].sum(axis=1, dtype=numpy.int32)
+
+
+# Unwanted hashes as one array of packed hashes, matched with a vectorized popcount.
+# For big lists, a multi-index: the bits are cut in threshold + 1 chunks, and a hash at a distance <= threshold
+# has at least one chunk exactly the same (pigeonhole), so only the hashes sharing a chunk are compared.
+class HashIndex(object):
+    def __init__(self, names, packed_hashes, threshold=THRESHOLD):
+        # type: (list[str], numpy.ndarray, int) -> None
+        self._names = names
+        self._packed_hashes = packed_hashes  # nb hashes x nb bytes, uint8
+        self._threshold = threshold
+        self._chunks = []  # type: list[numpy.ndarray]
+        self._chunk_tables = []  # type: list[dict[bytes, list[int]]]
+        if len(names) >= MULTI_INDEX_MIN_SIZE:
+            self._build_multi_index()
+    
+    
+    def __len__(self):
+        return len(self._names)
+    
+    
+    # Changes when the matched hashes or the threshold change: the names do not matter
+    def get_digest(self):
+        # type: () -> str
+        digest = hashlib.sha256(b'%d:%d:' % (HASH_SIZE, self._threshold))
+        for packed_hash in sorted(bytes(row) for row in self._packed_hashes):  # the same whatever the files order
+            digest.update(packed_hash)
+        return digest.hexdigest()
+    
+    
+    def _build_multi_index(self):
+        all_bits = numpy.unpackbits(self._packed_hashes, axis=1)
+        self._chunks = numpy.array_split(numpy.arange(all_bits.shape[1]), self._threshold + 1)
+        for chunk in self._chunks:
+            chunk_table = {}
+            for (idx, chunk_bits) in enumerate(all_bits[:, chunk]):
+                chunk_table.setdefault(chunk_bits.tobytes(), []).append(idx)
+            self._chunk_tables.append(chunk_table)
+    
+    
+    def _get_candidates(self, packed_hash):
+        # type: (numpy.ndarray) -> numpy.ndarray
+        bits = numpy.unpackbits(packed_hash)
+        candidates = set()
+        for (chunk, chunk_table) in zip(self._chunks, self._chunk_tables):
+            candidates.update(chunk_table.get(bits[chunk].tobytes(), ()))
+        return numpy.array(sorted(candidates), dtype=numpy.intp)
+    
+    
+    # Nearest hash at a distance <= threshold: (name, distance), or (None, None). On equal distances, the first
+    # one of the list wins.
+    def find_best(self, packed_hash, threshold=None):
+        # type: (numpy.ndarray, int|None) -> tuple[str|None, int|None]
+        threshold = self._threshold if threshold is None else threshold
+        if len(self._names) == 0:
+            return None, None
+        if self._chunk_tables and threshold <= self._threshold:
+            rows = self._get_candidates(packed_hash)
+            if len(rows) == 0:
+                return None, None
+            distances = get_distances(self._packed_hashes[rows], packed_hash)
+        else:
+            rows = None
+            distances = get_distances(self._packed_hashes, packed_hash)
+        best = int(distances.argmin())
+        if distances[best] > threshold:
+            return None, None
+        name_idx = best if rows is None else int(rows[best])
+        return self._names[name_idx], int(distances[best])
+
+
+# The unwanted hashes on disk, so a process only hashes the new or changed files of UNWANTED, and all the
+# conversion processes map the same file read only instead of each one having its copy. Flat layout:
+#   header: magic, version, nb entries, hash bytes, names size
+#   sizes (nb x u8), mtimes in ns (nb x i8), name ends (nb x u8), hashes (nb x hash bytes), utf8 names
+HASH_INDEX_FILE = '.henskan_hashes.bin'
+HASH_INDEX_VERSION = 1
+_HASH_INDEX_MAGIC = b'HSKH'
+_HASH_INDEX_HEADER = struct.Struct('<4sIIIQ')
+_HASH_BYTES = (HASH_SIZE * HASH_SIZE + 7) // 8
+
+
+class HashIndexFile(object):
+    def __init__(self, names, sizes, mtimes, packed_hashes):
+        # type: (list[str], numpy.ndarray, numpy.ndarray, numpy.ndarray) -> None
+        self.names = names
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.packed_hashes = packed_hashes
+    
+    
+    # None if there is no valid index file
+    @staticmethod
+    def read(path):
+        # type: (str) -> HashIndexFile|None
+        try:
+            data = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+            magic, version, nb_entries, hash_bytes, names_size = _HASH_INDEX_HEADER.unpack_from(data, 0)
+        except (OSError, ValueError, struct.error):  # missing, empty or truncated
+            return None
+        if magic != _HASH_INDEX_MAGIC or version != HASH_INDEX_VERSION or hash_bytes != _HASH_BYTES:
+            return None
+        # Check the sizes before slicing: a truncated file would give arrays of a wrong size
+        if _HASH_INDEX_HEADER.size + nb_entries * (24 + hash_bytes) + names_size != len(data):
+            return None
+        offset = _HASH_INDEX_HEADER.size
+        arrays = []
+        for (dtype, item_size) in (('<u8', 8), ('<i8', 8), ('<u8', 8), (numpy.uint8, hash_bytes)):
+            end = offset + nb_entries * item_size
+            arrays.append(data[offset:end].view(dtype))
+            offset = end
+        sizes, mtimes, name_ends, packed_hashes = arrays
+        try:
+            names_blob = data[offset:].tobytes().decode('utf8')
+        except UnicodeDecodeError:  # corrupted, it will be rebuilt
+            return None
+        name_starts = [0] + name_ends[:-1].tolist()
+        names = [names_blob[start:end] for (start, end) in zip(name_starts, name_ends.tolist())]
+        return HashIndexFile(names, sizes, mtimes, packed_hashes.reshape(nb_entries, hash_bytes))
+    
+    
+    def write(self, path):
+        # type: (str) -> None
+        encoded_names = [name.encode('utf8') for name in self.names]
+        # The ends are in characters, for the decoded blob
+        name_ends = numpy.cumsum([len(name) for name in self.names], dtype=numpy.uint64)
+        names_blob = b''.join(encoded_names)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_HASH_INDEX_HEADER.pack(_HASH_INDEX_MAGIC, HASH_INDEX_VERSION, len(self.names), _HASH_BYTES, len(names_blob)))
+            f.write(numpy.asarray(self.sizes, dtype='<u8').tobytes())
+            f.write(numpy.asarray(self.mtimes, dtype='<i8').tobytes())
+            f.write(name_ends.astype('<u8').tobytes())
+            f.write(numpy.ascontiguousarray(self.packed_hashes, dtype=numpy.uint8).tobytes())
+            f.write(names_blob)
+        os.replace(tmp_path, path)  # atomic: another process reads the old or the new one, never a partial one
+
+
+_is_deleted_cleaned = False  # once by process: the books of a library/GUI session keep the dumps of the previous ones
+
+
+# The deleted images of the previous runs. The list is taken now, so the images this run saves meanwhile are
+# kept, and the unlinks are done in a thread. The metadata file is appended to by this run: it is emptied
+# now, before any worker writes to it, and not given to the thread.
+# Give the thread, or None if there is nothing to remove.
+def clean_deleted_directory():
+    # type: () -> threading.Thread|None
+    global _is_deleted_cleaned
+    if _is_deleted_cleaned:
+        return None
+    _is_deleted_cleaned = True
+    if not os.path.exists(DELETED):
+        return None
+    metadata_path = os.path.join(DELETED, DELETED_METADATA_FILE)
+    if os.path.exists(metadata_path):
+        open(metadata_path, 'w').close()
+    full_paths = [os.path.join(DELETED, f_path) for f_path in os.listdir(DELETED) if f_path != DELETED_METADATA_FILE]
+    if not full_paths:
+        return None
+    print(" * Cleaning deleted dir: %s (%s files, in background)" % (DELETED, len(full_paths)))
+    thread = threading.Thread(target=_remove_files, args=(full_paths,), name='clean-deleted', daemon=True)
+    thread.start()
+    return thread
+
+
+def _remove_files(full_paths):
+    # type: (list[str]) -> None
+    for full_path in full_paths:
+        try:
+            os.unlink(full_path)
+        except OSError:  # already removed, or not a file
+            pass
+
+
+# The caps of a conversion run, shared by the main process and its pool workers: the converter makes a new
+# one at each run and gives it to the workers with the pool initializer
+class DeletedDumpBudget(object):
+    def __init__(self):
+        context = multiprocessing.get_context('spawn')
+        self._nb_entries = context.Value('q', 0)
+        self._nb_bytes = context.Value('q', 0)
+    
+    
+    def reserve_entry(self):
+        # type: () -> bool
+        with self._nb_entries.get_lock():
+            if self._nb_entries.value >= DELETED_MAX_ENTRIES:
+                return False
+            self._nb_entries.value += 1
+            return True
+    
+    
+    def reserve_bytes(self, nb_bytes):
+        # type: (int) -> bool
+        with self._nb_bytes.get_lock():
+            if self._nb_bytes.value + nb_bytes > DELETED_MAX_BYTES:
+                return False
+            self._nb_bytes.value += nb_bytes
+            return True
+    
+    
+    def get_usage(self):
+        # type: () -> tuple[int, int]
+        return self._nb_entries.value, self._nb_bytes.value
+
+
+_deleted_budget = None  # type: DeletedDumpBudget|None
+
+
+def set_deleted_budget(budget):
+    # type: (DeletedDumpBudget|None) -> None
+    global _deleted_budget
+    _deleted_budget = budget
+
+
+# Outside of a conversion run (scripts), the process has its own budget
+def get_deleted_budget():
+    # type: () -> DeletedDumpBudget
+    global _deleted_budget
+    if _deleted_budget is None:
+        _deleted_budget = DeletedDumpBudget()
+    return _deleted_budget
+
+
+class DeletedImageWriter(object):
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=DELETED_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._thread = None  # type: threading.Thread|None
+        self._nb_written = 0
+        self._nb_dropped = 0  # queue full, or over the caps
+        self._nb_bytes = 0
+    
+    
+    # Never blocks: give False if the dump is dropped
+    def add(self, file_name, image, reason, distance, dump):
+        # type: (str, Image, str, str|int, DELETED_DUMP) -> bool
+        with self._lock:
+            if self._queue.full() or not get_deleted_budget().reserve_entry():
+                self._nb_dropped += 1
+                return False
+            self._queue.put_nowait((file_name, image, reason, distance, dump))  # only this method puts, under the lock
+            if self._thread is None:
+                # Not a daemon: the queued dumps are still written when the process exits
+                self._thread = threading.Thread(target=self._run, name='deleted-writer')
+                self._thread.start()
+        return True
+    
+    
+    # Stops when the main thread is done and the queue is empty
+    def _run(self):
+        while True:
+            try:
+                entry = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                if not threading.main_thread().is_alive():
+                    break
+                continue
+            try:
+                self._write(*entry)
+            except Exception as exp:  # a debug dump must never stop the conversion
+                print(" * Cannot write the deleted image %s: %s" % (entry[0], exp))
+        with self._lock:
+            if self._nb_written or self._nb_dropped:
+                print(" * Deleted images dumps: %s written (%s bytes), %s dropped" % (self._nb_written, self._nb_bytes, self._nb_dropped))
+    
+    
+    def _write(self, file_name, image, reason, distance, dump):
+        # type: (str, Image, str, str|int, DELETED_DUMP) -> None
+        nb_bytes = 0
+        if dump == DELETED_DUMP.IMAGES:
+            f = io.BytesIO()
+            image.save(f, 'JPEG')
+            data = f.getvalue()
+            if not get_deleted_budget().reserve_bytes(len(data)):
+                with self._lock:
+                    self._nb_dropped += 1
+                return
+            with open(os.path.join(DELETED, file_name), 'wb') as out:
+                out.write(data)
+            nb_bytes = len(data)
+        hash = str(imagehash.average_hash(image, hash_size=HASH_SIZE)) if imagehash is not None else None
+        line = json.dumps({'file': file_name if dump == DELETED_DUMP.IMAGES else None,
+                           'reason': reason, 'distance': distance, 'hash': hash, 'size': list(image.size)}) + '\n'
+        # One write by line in append mode, so the lines of the worker processes do not mix
+        with open(os.path.join(DELETED, DELETED_METADATA_FILE), 'a', encoding='utf8') as out:
+            out.write(line)
+        with self._lock:
+            self._nb_written += 1
+            self._nb_bytes += nb_bytes + len(line)
+
 
 class Similarity(object):
     def __init__(self):
-        self._unwanted_hashes = {}
+        t0 = time.time()
+        self._unwanted_index = HashIndex([], numpy.zeros((0, 0), dtype=numpy.uint8))
         
-        self._clean()
+        self._make_directories()
         self._load()
         
         self._sum_time = 0.0
         self._nb_deleted = 0
+        self._deleted_writer = DeletedImageWriter()
+        print(" * Unwanted images check ready in %.3fs" % (time.time() - t0))
     
     
-    def _clean(self):
-        if not os.path.exists(DELETED):
-            print("CANNOT SAVE DELETED")
-            return
-        print(" * Cleaning deleted dir: %s" % DELETED)
-        for f_path in os.listdir(DELETED):
-            full_path = os.path.join(DELETED, f_path)
-            os.unlink(full_path)
+    @staticmethod
+    def _make_directories():
+        for directory in (UNWANTED, DELETED):
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError as exp:
+                print("CANNOT CREATE %s: %s" % (directory, exp))
     
     
+    # Only the files that are not in the index file with the same size and mtime are hashed. If none, the hashes
+    # are used directly from the mapped index file.
     def _load(self):
+        if imagehash is None:
+            return
         t0 = time.time()
         print(" * Loading unwanted images: %s" % UNWANTED)
-        for f_path in os.listdir(UNWANTED):
-            full_path = os.path.join(UNWANTED, f_path)
-            hash = imagehash.average_hash(Image.open(full_path), hash_size=HASH_SIZE)
-            self._unwanted_hashes[f_path] = hash
-        print("   - %s hashed loaded in %.3fs" % (len(self._unwanted_hashes), time.time() - t0))
+        index_path = os.path.join(UNWANTED, HASH_INDEX_FILE)
+        index_file = HashIndexFile.read(index_path)
+        known = {}  # name => (size, mtime, row in the index file)
+        if index_file is not None:
+            for (row, (name, size, mtime)) in enumerate(zip(index_file.names, index_file.sizes.tolist(), index_file.mtimes.tolist())):
+                known[name] = (size, mtime, row)
+        
+        names = []
+        sizes = []
+        mtimes = []
+        packed_hashes = []
+        rows = []  # row in the index file, or -1 for a new hash
+        nb_hashed = 0
+        for entry in sorted(os.scandir(UNWANTED), key=lambda entry: entry.name):
+            if entry.name.startswith(HASH_INDEX_FILE) or not entry.is_file():  # the index and its tmp files
+                continue
+            stat = entry.stat()
+            known_entry = known.get(entry.name)
+            if known_entry is not None and known_entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                row = known_entry[2]
+                packed_hash = index_file.packed_hashes[row]
+            else:
+                try:
+                    hash = imagehash.average_hash(Image.open(entry.path), hash_size=HASH_SIZE)
+                except (IOError, ValueError):
+                    print("   - cannot hash %s, skipping it" % entry.path)
+                    continue
+                row = -1
+                packed_hash = pack_hash(hash)
+                nb_hashed += 1
+            names.append(entry.name)
+            sizes.append(stat.st_size)
+            mtimes.append(stat.st_mtime_ns)
+            packed_hashes.append(packed_hash)
+            rows.append(row)
+        
+        if index_file is not None and rows == list(range(len(index_file.names))):  # the index file is up to date
+            hashes = index_file.packed_hashes
+        else:
+            hashes = numpy.array(packed_hashes, dtype=numpy.uint8).reshape(len(names), _HASH_BYTES)
+            try:
+                HashIndexFile(names, numpy.array(sizes), numpy.array(mtimes), hashes).write(index_path)
+            except OSError as exp:  # a read only UNWANTED is ok, we just hash again the next time
+                print("   - cannot write the hash index %s: %s" % (index_path, exp))
+        self._unwanted_index = HashIndex(names, hashes)
+        print("   - %s hashed loaded in %.3fs (%s hashed, %s from the index file)" % (len(self._unwanted_index), time.time() - t0, nb_hashed, len(names) - nb_hashed))
     
     
+    # The dump is queued to the writer thread, see DELETED_DUMP
     def add_deleted_image(self, f_path, image, diff, do_move):
         self._nb_deleted += 1
         print(" * Image is unwanted (from %s), deleted=%s" % (f_path, self._nb_deleted))
-        save_deleted_path = os.path.join(DELETED, 'deleted_%s--diff_%s__%s.jpg' % (f_path, diff, self._nb_deleted))
-        if do_move:
-            image.save(save_deleted_path)
+        dump = DELETED_DUMP(parameters.get_deleted_dump())
+        if not do_move or dump == DELETED_DUMP.NONE:
+            return
+        # The pid, as all the worker processes write there
+        file_name = 'deleted_%s--diff_%s__%s_%s.jpg' % (f_path, diff, os.getpid(), self._nb_deleted)
+        self._deleted_writer.add(file_name, image, f_path, diff, dump)
+    
+    
+    # The webtoon pages depend on the unwanted images: it is a part of their page cache key
+    def get_unwanted_digest(self):
+        # type: () -> str
+        if imagehash is None:  # nothing is dropped
+            return 'none'
+        return self._unwanted_index.get_digest()
+    
+    
+    # The nearest unwanted image: (file name, distance), or (None, None) if none is under THRESHOLD
+    def find_unwanted(self, image):
+        # type: (Image) -> tuple[str|None, int|None]
+        hash = imagehash.average_hash(image, hash_size=HASH_SIZE)
+        return self._unwanted_index.find_best(pack_hash(hash))
     
     
     def is_valid_image(self, image, do_move=True):
@@ -88,23 +482,30 @@ class Similarity(object):
             return True
         elapsed_at_start = int(self._sum_time)
         t0 = time.time()
-        hash = imagehash.average_hash(image, hash_size=HASH_SIZE)
-        is_valid = True
-        for (f_path, ref_hash) in self._unwanted_hashes.items():
-            diff = hash - ref_hash
-            if diff <= THRESHOLD:
-                self.add_deleted_image(f_path, image, diff, do_move=do_move)
-                # self._nb_deleted += 1
-                # print " * Image is unwanted (from %s), deleted=%s" % (f_path, self._nb_deleted)
-                # save_deleted_path = os.path.join(DELETED, 'deleted_%s--diff_%s__%s.jpg' % (f_path, diff, self._nb_deleted))
-                # if do_move:
-                #     image.save(save_deleted_path)
-                is_valid = False
-                break
+        (f_path, diff) = self.find_unwanted(image)
+        is_valid = f_path is None
+        if not is_valid:
+            self.add_deleted_image(f_path, image, diff, do_move=do_move)
         self._sum_time += (time.time() - t0)
         if int(self._sum_time) != elapsed_at_start:
             print("[UNWANTED:] Consume time= %s" % int(self._sum_time))
         return is_valid
 
 
-similarity = Similarity()
+_similarity = None  # type: Similarity|None
+_similarity_lock = threading.Lock()
+
+
+# The Similarity of this process, done at the first call: importing this module does not touch the disk.
+# The converter calls it once in the main process before the workers start, so the hash index file is up
+# to date and each worker only maps it at its first webtoon block. With refresh, an already done one loads
+# again the unwanted images, as they may have changed since the previous book.
+def get_similarity(refresh=False):
+    # type: (bool) -> Similarity
+    global _similarity
+    with _similarity_lock:
+        if _similarity is None:
+            _similarity = Similarity()
+        elif refresh:
+            _similarity._load()
+        return _similarity
@@ -3,7 +3,7 @@ import shutil
 import imagehash
 import os
 from image import Image, _is_full_background_image
-from similarity import similarity
+from similarity import get_similarity
 
 SIM_DIR = 'resources/similaires'
 
@@ -71,7 +71,7 @@ for f_path in files:
     full_path = os.path.join(SRC, f_path)
     img = Image.open(full_path)
     
-    is_valid = similarity.is_valid_image(img, do_move=False)
+    is_valid = get_similarity().is_valid_image(img, do_move=False)
     is_full_background = _is_full_background_image(img)
     if is_valid and not is_full_background:
         pth = os.path.join(VALID, f_path)
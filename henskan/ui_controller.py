@@ -17,8 +17,6 @@
 
 import os
 import random
-import re
-from typing import LiteralString
 
 from PyQt6.QtCore import QObject, pyqtSlot, pyqtSignal, QThread
 from PyQt6.QtWidgets import QFileDialog
@@ -26,6 +24,7 @@ from PyQt6.QtWidgets import QFileDialog
 from .image import guess_manga_or_webtoon_image, is_splitable
 from .parameters import parameters
 from .ui_component import UIInput, UIRectButton, UIComboBox, UIProgressBar, UIRectButtonConvert
+from .util import is_image_file, list_image_files, clean_title
 from .worker import Worker
 
 COMPONENTS = {
@@ -114,19 +113,6 @@ class UIController(QObject):
         self._check_for_convert_ready()
     
     
-    @staticmethod
-    def __get_file_extension(filename):
-        # type: (LiteralString | str| bytes) -> str
-        return os.path.splitext(filename)[1].lower()
-    
-    
-    def __is_image_file(self, filename):
-        # type: (LiteralString | str | bytes) -> bool
-        image_exts = ('.jpeg', '.jpg', '.gif', '.png')
-        
-        return os.path.isfile(filename) and self.__get_file_extension(filename) in image_exts
-    
-    
     def start_converting(self):
         for component in self._components.values():
             component.disable_interaction()
@@ -145,7 +131,7 @@ class UIController(QObject):
             print(f'onFilesDropped::File path: {file_path}')
             if not file_path:
                 continue
-            if self.__is_image_file(file_path):
+            if is_image_file(file_path):
                 self.add_file_path(file_path, 0.33)
             elif os.path.isdir(file_path):
                 self.__add_directory(file_path)
@@ -202,9 +188,7 @@ class UIController(QObject):
         print(f'raw_title: {raw_title}')
         
         # Clean all that is between [] and () in this string
-        title = re.sub(r'\[.*?\]', '', raw_title)
-        title = re.sub(r'\(.*?\)', '', title)
-        title = title.strip()
+        title = clean_title(raw_title)
         
         print(f'Final title: {title}')
         self._set_title(title)
@@ -279,11 +263,8 @@ class UIController(QObject):
     
     
     def __add_directory(self, directory):
-        for root, _, subfiles in os.walk(directory):
-            for filename in subfiles:
-                file_path = os.path.join(root, filename)
-                if self.__is_image_file(file_path):
-                    self.add_file_path(file_path, 0.33)
+        for file_path in list_image_files(directory):
+            self.add_file_path(file_path, 0.33)
     
     
     @pyqtSlot()
@@ -18,6 +18,8 @@
 import os.path
 import re
 
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.gif', '.png')
+
 
 # Sort function use to sort files in a natural order, by lowering
 # characters, and manage multi levels of integers (tome 1/ page 1.jpg, etc etc)
@@ -37,3 +39,27 @@ def get_ui_path(relative):
     # type: (str) -> str
     my_dir = os.path.abspath(os.path.dirname(__file__))
     return os.path.join(my_dir, relative)
+
+
+def is_image_file(filename):
+    # type: (str) -> bool
+    return os.path.isfile(filename) and os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS
+
+
+def list_image_files(directory):
+    # type: (str) -> list[str]
+    image_paths = []
+    for root, _, subfiles in os.walk(directory):
+        for filename in subfiles:
+            file_path = os.path.join(root, filename)
+            if is_image_file(file_path):
+                image_paths.append(file_path)
+    return image_paths
+
+
+# Directory names are like "[Team] My Manga (2020)": clean all that is between [] and ()
+def clean_title(raw_title):
+    # type: (str) -> str
+    title = re.sub(r'\[.*?\]', '', raw_title)
+    title = re.sub(r'\(.*?\)', '', title)
+    return title.strip()
@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 import sys
 
@@ -12,6 +13,7 @@ from henskan.file_path_model import FilePathModel
 import henskan
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # the page conversion pool re-launch this exe in the frozen build
     lib_dir = os.path.dirname(henskan.__file__)
     app = QApplication(sys.argv)
     app.setWindowIcon(QIcon(os.path.join(lib_dir, 'img', 'splash.jpg')))